@@ -0,0 +1,69 @@
+"""
+Compares the old scanning ``ExpiringDict`` against the heap backed one in ``storage_cache`` for message cooldowns.
+
+Run from the repository root with ``python -m benchmarks.cooldowns [active] [lookups]``.
+"""
+import random
+import sys
+import time
+
+from bot.util import storage_cache
+
+
+class ScanningExpiringDict(dict):
+    """How cooldowns were stored before the heap, checking every entry on each lookup."""
+
+    def __init__(self, seconds):
+        self._default_expiring = seconds
+        super().__init__()
+
+    def __contains__(self, key):
+        self._verify_cache_integrity()
+        return super().__contains__(key)
+
+    def set(self, key, value, seconds):
+        super().__setitem__(key, (value, time.monotonic() + seconds))
+
+    def _verify_cache_integrity(self):
+        current_time = time.monotonic()
+        to_remove = [
+            key for (key, (_, time_expire)) in self.items() if current_time > time_expire
+        ]
+        for key in to_remove:
+            self.pop(key)
+
+
+def fill(cooldowns, active):
+    for user_id in range(active):
+        cooldowns.set((0, user_id), 1, 60)
+
+
+def measure(cooldowns, active, lookups):
+    """Does what on_message does: check the cooldown and set it again."""
+    keys = [(0, random.randrange(active * 2)) for _ in range(lookups)]
+    start = time.perf_counter()
+    for key in keys:
+        if key not in cooldowns:
+            cooldowns.set(key, 1, 60)
+    return (time.perf_counter() - start) / lookups
+
+
+def main(active, lookups):
+    print('{0} active cooldowns'.format(active))
+    times = {}
+    # The old one is too slow to do as many lookups
+    for name, cooldowns, amount in (
+        ('scan', ScanningExpiringDict(60), max(lookups // 100, 1)),
+        ('heap', storage_cache.ExpiringDict(60), lookups),
+    ):
+        fill(cooldowns, active)
+        times[name] = measure(cooldowns, active, amount)
+        print('{0:<5} {1:.2f}us per message ({2} lookups)'.format(name, times[name] * 1000000, amount))
+    print('{0:.0f}x faster'.format(times['scan'] / times['heap']))
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 100000,
+    )
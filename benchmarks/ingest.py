@@ -0,0 +1,104 @@
+"""
+Compares writing a message push by formatting one large statement against copying into the staging table.
+
+Run from the repository root with ``python -m benchmarks.ingest [counters] [runs]``. Everything is written into
+temporary tables that shadow the real ones, so nothing is kept in the database.
+"""
+import asyncio
+import random
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+import asyncpg
+
+import bot as bot_storage
+from bot.cogs.stats import messages
+from bot.util import time_util as tutil
+from bot.util.config import Config
+
+SETUP = """
+CREATE TEMP TABLE messages (LIKE public.messages INCLUDING DEFAULTS);
+ALTER TABLE messages ADD CONSTRAINT unique_message UNIQUE (guild_id, channel_id, user_id, time);
+CREATE TEMP TABLE messages_hourly (LIKE public.messages_hourly INCLUDING DEFAULTS);
+ALTER TABLE messages_hourly ADD CONSTRAINT unique_message_hour UNIQUE (guild_id, time);
+CREATE TEMP TABLE messages_daily (LIKE public.messages_daily INCLUDING DEFAULTS);
+CREATE UNIQUE INDEX ON messages_daily (guild_id, COALESCE(channel_id, 0), COALESCE(user_id, 0), time);
+CREATE TEMP TABLE messages_staging (LIKE public.messages_staging INCLUDING DEFAULTS);
+"""
+
+CLEAR = 'TRUNCATE messages, messages_hourly, messages_daily, messages_staging;'
+
+
+async def write_values(connection, counts):
+    """How pushes were written before the staging table."""
+    insert = []
+    daily = []
+    hourly = Counter()
+    for (guild_id, channel_id, user_id, time), amount in counts.items():
+        time_str = time.strftime("'%Y-%m-%d %H:%M:%S'")
+        day_str = time.strftime("'%Y-%m-%d 00:00:00'")
+        insert.append("({0}, {1}, {2}, {3}, {4}, INTERVAL '30 MINUTES')".format(guild_id, channel_id, user_id, amount, time_str))
+        daily.append('({0}, {1}, {2}, {3}, {4})'.format(guild_id, channel_id, user_id, day_str, amount))
+        hourly[(guild_id, time.replace(minute=0).strftime("'%Y-%m-%d %H:%M:%S'"))] += amount
+    command = 'INSERT INTO messages(guild_id, channel_id, user_id, amount, time, interval) VALUES {0} ' \
+              'ON CONFLICT ON CONSTRAINT unique_message DO UPDATE SET amount = messages.amount + EXCLUDED.amount;'
+    hourly_command = 'INSERT INTO messages_hourly(guild_id, time, amount) VALUES {0} ' \
+                     'ON CONFLICT ON CONSTRAINT unique_message_hour DO UPDATE SET amount = messages_hourly.amount + EXCLUDED.amount;'
+    daily_command = 'INSERT INTO messages_daily(guild_id, channel_id, user_id, time, amount) VALUES {0} ' \
+                    'ON CONFLICT (guild_id, COALESCE(channel_id, 0), COALESCE(user_id, 0), time) ' \
+                    'DO UPDATE SET amount = messages_daily.amount + EXCLUDED.amount;'
+    async with connection.transaction():
+        await connection.execute(command.format(', '.join(insert)))
+        await connection.execute(hourly_command.format(', '.join(
+            '({0}, {1}, {2})'.format(guild_id, hour_str, amount) for (guild_id, hour_str), amount in hourly.items()
+        )))
+        await connection.execute(daily_command.format(', '.join(daily)))
+
+
+def make_counts(amount, *, guilds=200, channels=20, users=2000):
+    counts = Counter()
+    time = tutil.floor_time(top=30)
+    while len(counts) < amount:
+        guild_id = random.randrange(guilds)
+        key = (guild_id, guild_id * channels + random.randrange(channels), random.randrange(users), time)
+        counts[key] += random.randint(1, 5)
+    return counts
+
+
+async def measure(connection, function, counts, runs):
+    times = []
+    for _ in range(runs):
+        await connection.execute(CLEAR)
+        start = time.perf_counter()
+        await function(connection, counts)
+        times.append(time.perf_counter() - start)
+    return min(times), sum(times) / len(times)
+
+
+async def main(amount, runs):
+    bot_storage.config = Config(Path('./config.toml'))
+    connection = await asyncpg.connect(
+        database=bot_storage.config['postgresql_name'],
+        user=bot_storage.config['postgresql_user'],
+        password=bot_storage.config['postgresql_password'],
+        host='localhost',
+    )
+    try:
+        await connection.execute(SETUP)
+        counts = make_counts(amount)
+        for name, function in (('values', write_values), ('copy', messages.write_messages)):
+            best, average = await measure(connection, function, counts, runs)
+            print('{0:<8} {1} counters: best {2:.3f}s, average {3:.3f}s ({4:.0f} rows/s)'.format(
+                name, amount, best, average, amount / average,
+            ))
+    finally:
+        await connection.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 20000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 5,
+    ))
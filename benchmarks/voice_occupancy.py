@@ -0,0 +1,76 @@
+"""
+Compares the old per-entry loop for voice occupancy against the vectorised version in ``graphs``.
+
+Run from the repository root with ``python -m benchmarks.voice_occupancy [sessions] [days]``.
+"""
+import random
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from bot.util import graphs
+from bot.util import time_util as tutil
+
+
+def loop_occupancy(entries):
+    """How the voice graph counted users before it was vectorised."""
+    data = Counter()
+    logged = {}
+    for start, seconds, user_id in entries:
+        bucket = tutil.round_time(start, 60 * 30)
+        added = 0
+        while added < seconds:
+            if bucket not in logged:
+                logged[bucket] = []
+            if user_id not in logged[bucket]:
+                data[bucket] += 1
+                logged[bucket].append(user_id)
+            bucket = bucket + timedelta(minutes=30)
+            added += 60 * 30
+    return data
+
+
+def make_entries(sessions, days, *, users=500):
+    now = datetime(2021, 1, 1)
+    entries = []
+    for _ in range(sessions):
+        start = now - timedelta(seconds=random.randrange(days * 24 * 60 * 60))
+        entries.append((start, random.randrange(60, 6 * 60 * 60), random.randrange(users)))
+    return entries
+
+
+def as_columns(entries):
+    starts, seconds, users = zip(*entries)
+    return graphs.voice_occupancy(
+        np.array(starts, dtype='datetime64[s]'),
+        np.array(seconds, dtype=np.float64),
+        np.array(users, dtype=np.int64),
+    )
+
+
+def measure(function, entries):
+    start = time.perf_counter()
+    result = function(entries)
+    return result, time.perf_counter() - start
+
+
+def main(sessions, days):
+    entries = make_entries(sessions, days)
+    expected, loop_time = measure(loop_occupancy, entries)
+    # Includes building the columns, like the voice summary has to
+    (times, counts), numpy_time = measure(as_columns, entries)
+    found = {bucket.astype(datetime): count for bucket, count in zip(times, counts)}
+    print('{0} sessions over {1} days'.format(sessions, days))
+    print('loop   {0:.3f}s'.format(loop_time))
+    print('numpy  {0:.3f}s ({1:.1f}x)'.format(numpy_time, loop_time / numpy_time))
+    print('matches: {0}'.format(found == dict(expected)))
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 10000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 30,
+    )
@@ -85,6 +85,7 @@ class Data(commands.Cog):   # noqa: WPS110
         # Create voice command
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
             await con.execute(command)
+        self.mark_changed()
 
         await ctx.send(embed=ctx.create_embed('Deleted all data from {0} for {1}'.format(format_selection, format_interval)))
 
@@ -134,6 +135,7 @@ class Data(commands.Cog):   # noqa: WPS110
         # Create voice command
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
             await con.execute(command)
+        self.mark_changed()
 
         await ctx.send(
             embed=ctx.create_embed('Deleted all data from {0} for {1}'.format(format_selection, format_interval)))
@@ -164,29 +166,49 @@ class Data(commands.Cog):   # noqa: WPS110
             file=discord.File(fp=buffer, filename='data.csv'),
         )
 
+    def mark_changed(self):
+        # Cached summaries and graphs are keyed on the data version, so move that forward
+        self.bot.data_changed('Messages', 'Voice')
+
     async def get_all_guild_entries(self, guild_id):
         command = 'SELECT * FROM messages WHERE guild_id = {0};'
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
             return await con.fetch(command.format(str(guild_id)))
 
     def purge_message(self, before, interval, guild_id, selection):
-        builder = ['DELETE FROM messages WHERE guild_id = {0}'.format(guild_id)]
+        builder = ['guild_id = {0}'.format(guild_id)]
         deliminator = '<' if before else '>='
         if interval is not None:
             builder.append("time {0} NOW() at time zone 'utc' - INTERVAL '{1}'".format(deliminator, interval))
-        if selection is not None:
-            if isinstance(selection, (discord.User,)):
-                builder.append('user_id = {0}'.format(selection.id))
-            else:
-                builder.append('channel_id = {0}'.format(selection.id))
-
-        return '{0};'.format(' AND '.join(builder))
+        if selection is None:
+            return '{0}\n{1}\n{2}'.format(
+                'DELETE FROM messages WHERE {0};'.format(' AND '.join(builder)),
+                'DELETE FROM messages_hourly WHERE {0};'.format(' AND '.join(builder)),
+                'DELETE FROM messages_daily WHERE {0};'.format(' AND '.join(builder)),
+            )
+        if isinstance(selection, (discord.User,)):
+            builder.append('user_id = {0}'.format(selection.id))
+        else:
+            builder.append('channel_id = {0}'.format(selection.id))
+
+        # The hourly rollup has no users or channels, so take away what was removed instead
+        hourly = (
+            'WITH deleted AS (DELETE FROM messages WHERE {0} RETURNING *) '
+            'UPDATE messages_hourly AS hourly SET amount = hourly.amount - removed.amount FROM ('
+            "SELECT guild_id, date_trunc('hour', time) AS time, SUM(amount) AS amount FROM deleted "
+            'WHERE channel_id IS NOT NULL OR user_id IS NULL GROUP BY 1, 2'
+            ') AS removed WHERE hourly.guild_id = removed.guild_id AND hourly.time = removed.time;'
+        )
+        return '{0}\n{1}'.format(
+            hourly.format(' AND '.join(builder)),
+            'DELETE FROM messages_daily WHERE {0};'.format(' AND '.join(builder)),
+        )
 
     def purge_voice(self, before, interval, guild_id, selection):
         voice_builder = ['DELETE FROM voice WHERE guild_id = {0}'.format(guild_id)]
         deliminator = '<' if before else '>='
         if interval is not None:
-            voice_builder.append("time + amount {0} NOW() at time zone 'utc' - INTERVAL '{1}'".format(deliminator, interval))
+            voice_builder.append("time + interval {0} NOW() at time zone 'utc' - INTERVAL '{1}'".format(deliminator, interval))
         if selection is not None:
             if isinstance(selection, (discord.User,)):
                 voice_builder.append('user_id = {0}'.format(selection.id))
@@ -1,7 +1,11 @@
+import asyncio
+import json
+import logging
+
 from glocklib import database as db, checks
 from glocklib import context as Context
 from discord.ext import commands
-from bot.util import storage_cache as cache
+from bot.util import statements
 
 
 class GuildConfigTable(db.Table, table_name='guild_config'):
@@ -12,25 +16,58 @@ class GuildConfigTable(db.Table, table_name='guild_config'):
     detail_remove = db.Column(db.Integer(small=True), default='90')
     message_cooldown = db.Column(db.Integer(small=True), default='60')
 
+    @classmethod
+    def create_table(cls, *, overwrite=False):
+        statement = super().create_table(overwrite=overwrite)
+
+        # Sends the new settings to every bot that's listening whenever a row changes
+        trigger = """
+CREATE OR REPLACE FUNCTION notify_guild_config() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('guild_config', json_build_object('guild_id', OLD.guild_id, 'deleted', true)::text);
+    ELSE
+        PERFORM pg_notify('guild_config', json_build_object(
+            'guild_id', NEW.guild_id, 'prefix', NEW.prefix, 'message_cooldown', NEW.message_cooldown
+        )::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS guild_config_notify ON guild_config;
+CREATE TRIGGER guild_config_notify AFTER INSERT OR UPDATE OR DELETE ON guild_config
+FOR EACH ROW EXECUTE PROCEDURE notify_guild_config();
+"""
+
+        return '{0}\n{1}'.format(statement, trigger)
+
+
+GET_SETTINGS = statements.register(
+    'guild_settings',
+    'SELECT prefix, message_cooldown FROM guild_config WHERE guild_id = $1;',
+)
+
+ALL_SETTINGS = 'SELECT guild_id, prefix, message_cooldown FROM guild_config;'
+
 
 class GuildSettings:
-    __slots__ = ('guild', 'prefix', 'message_cooldown')
+    __slots__ = ('guild_id', 'prefix', 'message_cooldown')
 
-    def __init__(self, guild, prefix, message_cooldown):
-        self.guild = guild
+    def __init__(self, guild_id, prefix, message_cooldown):
+        self.guild_id = guild_id
         self.prefix = prefix
         self.message_cooldown = message_cooldown
 
     @classmethod
-    def get_default(cls, guild):
-        return cls(guild, '~', 60)
+    def get_default(cls, guild_id):
+        return cls(guild_id, '~', 60)
 
 
 async def get_guild_settings(bot, guild):
     """Get's basic guild settings information."""
     cog = bot.get_cog('GuildConfig')
     if cog is None:
-        return GuildSettings.get_default(guild)
+        return GuildSettings.get_default(guild.id)
     return await cog.get_settings(guild.id)
 
 
@@ -39,19 +76,94 @@ class GuildConfig(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        # Every row in guild_config, kept up to date by the notify trigger
+        self.settings = {}
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self._listener = None
+        self._load_task = self.bot.loop.create_task(self.load())
+
+    async def load(self):
+        """Loads every row and attaches the listener, trying again until both work."""
+        delay = 5
+        while True:
+            try:
+                await self._load()
+            except Exception:
+                logging.exception('Could not load guild settings, trying again in {0} seconds'.format(delay))
+                await self._drop_listener()
+            else:
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300)
+
+    async def _load(self):
+        if self._listener is None:
+            self._listener = await self.bot.pool.acquire()
+            # Listen first so nothing that changes while loading gets missed
+            await self._listener.add_listener('guild_config', self._on_notify)
+            self._listener.add_termination_listener(self._on_terminate)
+        rows = await self._listener.fetch(ALL_SETTINGS)
+        self.settings = {
+            row['guild_id']: GuildSettings(row['guild_id'], row['prefix'], row['message_cooldown']) for row in rows
+        }
+        self.loaded = True
+        logging.info('Loaded settings for {0} guilds'.format(len(self.settings)))
+
+    def _on_notify(self, connection, pid, channel, payload):
+        data = json.loads(payload)
+        guild_id = data['guild_id']
+        if data.get('deleted'):
+            self.settings.pop(guild_id, None)
+            return
+        self.settings[guild_id] = GuildSettings(guild_id, data['prefix'], data['message_cooldown'])
+
+    def _on_terminate(self, connection):
+        # Changes made while nothing was listening would be missed, so load everything again
+        logging.warning('Lost the guild_config listener, reloading settings')
+        self.loaded = False
+        self._load_task.cancel()
+        self._load_task = self.bot.loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        await self._drop_listener()
+        await self.load()
+
+    async def _drop_listener(self):
+        """Gives the listening connection back to the pool, which replaces it if it's dead."""
+        listener = self._listener
+        self._listener = None
+        if listener is None:
+            return
+        listener.remove_termination_listener(self._on_terminate)
+        try:
+            if not listener.is_closed():
+                await listener.remove_listener('guild_config', self._on_notify)
+            await self.bot.pool.release(listener)
+        except Exception:
+            logging.exception('Could not release the guild_config listener')
+            listener.terminate()
+
+    def cog_unload(self):
+        self._load_task.cancel()
+        if self._listener is not None:
+            self.bot.loop.create_task(self._drop_listener())
 
-    @cache.cache()
     async def get_settings(self, guild_id):
-        guild = self.bot.get_guild(guild_id)
-        if guild is None:
-            return None
-        command = 'SELECT prefix, message_cooldown FROM guild_config WHERE guild_id = {0};'
-        command = command.format(guild_id)
+        if self.loaded:
+            self.hits += 1
+            settings = self.settings.get(guild_id)
+            if settings is None:
+                return GuildSettings.get_default(guild_id)
+            return settings
+        # Still loading, so go to the database
+        self.misses += 1
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            entry = await con.fetchrow(command)
+            entry = await GET_SETTINGS.fetchrow(con, guild_id)
         if entry is None:
-            return GuildSettings.get_default(guild)
-        return GuildSettings(guild, entry['prefix'], entry['message_cooldown'])
+            return GuildSettings.get_default(guild_id)
+        return GuildSettings(guild_id, entry['prefix'], entry['message_cooldown'])
 
     @commands.command(name='!prefix')
     @checks.is_manager()
@@ -64,11 +176,10 @@ class GuildConfig(commands.Cog):
         """
         if prefix is None or len(prefix) > 6 or len(prefix) < 1:
             return await ctx.send('You need to specify a prefix of max length 6 and minimum length 1!')
-        command = 'INSERT INTO guild_config(guild_id, prefix) VALUES ({0}, %s) ON CONFLICT (guild_id) DO UPDATE SET prefix = EXCLUDED.prefix;'  # noqa: WPS323
+        command = 'INSERT INTO guild_config(guild_id, prefix) VALUES ({0}, $1) ON CONFLICT (guild_id) DO UPDATE SET prefix = EXCLUDED.prefix;'
         command = command.format(str(ctx.guild.id))
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            con.execute(command, prefix)
-        self.get_settings.invalidate(self, ctx.guild.id)
+            await con.execute(command, prefix)
         await ctx.send(embed=ctx.create_embed(description='Updated prefix to `{0}`'.format(prefix)))
 
     @commands.command(name='*flat', hidden=True)
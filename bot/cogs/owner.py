@@ -13,6 +13,8 @@ import discord
 import typing
 
 from bot import synth_bot
+from bot.util import statements
+from bot.util import storage_cache
 from discord.ext import commands, menus
 
 from glocklib import command_config
@@ -218,6 +220,80 @@ class Owner(commands.Cog):
 
         await ctx.send(embed=ctx.create_embed('\n'.join(f'{status}: `{module}`' for status, module in statuses)))
 
+    @commands.command(hidden=True, name='*render')
+    async def render_stats(self, ctx):
+        """Shows how the graph renderer is performing."""
+        renderer = self.bot.renderer
+        metrics = renderer.metrics
+        message = (
+            'Workers: `{0}`\nPending: `{1}/{2}`\n\nCompleted: `{3}`\nFailed: `{4}`\nTimed out: `{5}`\nRejected: `{6}`\n\n'
+            'Queue wait: `{7:.3f}s` average, `{8:.3f}s` max\nRender time: `{9:.3f}s` average, `{10:.3f}s` max\n\n'
+            'Cache: `{11}` graphs using `{12}/{13}` bytes\nCache hits: `{14}`\nCache misses: `{15}`'
+        )
+        message = message.format(
+            renderer.workers,
+            renderer.pending,
+            renderer.max_queue,
+            metrics.completed,
+            metrics.failed,
+            metrics.timed_out,
+            metrics.rejected,
+            metrics.average_wait(),
+            metrics.max_wait(),
+            metrics.average_render(),
+            metrics.max_render(),
+            len(self.bot.graph_cache),
+            self.bot.graph_cache.size,
+            self.bot.graph_cache.max_bytes,
+            self.bot.graph_cache.hits,
+            self.bot.graph_cache.misses,
+        )
+        await ctx.send(embed=ctx.create_embed(message, title='Graph Renderer'))
+
+    @commands.command(hidden=True, name='*statements')
+    async def statement_stats(self, ctx):
+        """Shows how often each registered statement is run and how long it takes."""
+        message = []
+        for statement in sorted(statements.registry, key=lambda s: s.total_time, reverse=True):
+            message.append('`{0}` - `{1}` calls, `{2:.2f}ms` average, p50 `<={3}ms`, p99 `<={4}ms`'.format(
+                statement.name,
+                statement.calls,
+                statement.average() * 1000,
+                statement.percentile(50),
+                statement.percentile(99),
+            ))
+        await ctx.send(embed=ctx.create_embed('\n'.join(message), title='Statements'))
+
+    @commands.command(hidden=True, name='*settings')
+    async def settings_stats(self, ctx):
+        """Shows how the preloaded guild settings are doing."""
+        g_config = self.bot.get_cog('GuildConfig')
+        if g_config is None:
+            return await ctx.send(embed=ctx.create_embed('GuildConfig is not loaded!', error=True))
+        message = 'Loaded: `{0}`\nGuilds: `{1}`\nHits: `{2}`\nMisses: `{3}`'.format(
+            g_config.loaded,
+            len(g_config.settings),
+            g_config.hits,
+            g_config.misses,
+        )
+        await ctx.send(embed=ctx.create_embed(message, title='Guild Settings'))
+
+    @commands.command(hidden=True, name='*caches')
+    async def cache_stats(self, ctx):
+        """Shows how every cached function is doing."""
+        message = []
+        for store in storage_cache.registry:
+            message.append('`{0}` - `{1}/{2}` entries, `{3}` hits, `{4}` misses, `{5}` shared, `{6}` evicted'.format(
+                store.name,
+                len(store),
+                store.maxsize,
+                store.hits,
+                store.misses,
+                store.shared,
+                store.evictions,
+            ))
+        await ctx.send(embed=ctx.create_embed('\n'.join(message), title='Caches'))
+
     @commands.command(hidden=True, name='*sudo')
     async def sudo(self, ctx, channel: typing.Optional[GlobalChannel], who: typing.Union[discord.Member, discord.User], *, command: str):
         """Run a command as another user optionally in another channel."""
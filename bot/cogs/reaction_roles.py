@@ -1,9 +1,12 @@
+import asyncio
 import enum
+import logging
 
 import discord
 from discord.ext import commands
 
 from glocklib import database as db, checks
+from bot.util import statements
 from bot.util import storage_cache as cache
 from glocklib import context as Context
 from bot.util.emoji_util import Emoji
@@ -42,6 +45,19 @@ class ReactionRolesTable(db.Table, table_name='reaction_roles'):
         return '{0}\n{1}'.format(statement, sql)
 
 
+# Everything needed for the index, one row per reaction (or one with no reaction for a message without any)
+ALL_REACTION_ROLES = """
+SELECT reaction_messages.message_id, reaction_messages.guild_id, reaction_messages.channel_id, reaction_messages.type,
+       reaction_roles.role_id, reaction_roles.reaction
+FROM reaction_messages LEFT JOIN reaction_roles USING (reaction_role_id)
+"""
+# Used for a single message while the index couldn't be loaded
+GET_REACTION_MESSAGE = statements.register(
+    'reaction_message',
+    ALL_REACTION_ROLES + 'WHERE reaction_messages.guild_id = $1 AND reaction_messages.message_id = $2;',
+)
+
+
 class ReactionType(enum.Enum):
 
     toggle = 0
@@ -65,6 +81,21 @@ class ReactionRole:
         self.role = role
 
 
+class IndexedMessage:
+    """A reaction role message as it's stored, with reactions mapped to role IDs."""
+
+    __slots__ = ('guild_id', 'channel_id', 'reaction_type', 'roles')
+
+    def __init__(self, guild_id, channel_id, reaction_type):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        try:
+            self.reaction_type = ReactionType(reaction_type)
+        except ValueError:
+            self.reaction_type = ReactionType.toggle
+        self.roles = {}
+
+
 class ReactionRolesContainer:
 
     def __init__(self, guild, channel, message, roles, reaction_type):
@@ -75,12 +106,10 @@ class ReactionRolesContainer:
         self.reaction_type = reaction_type
 
     def get_react(self, react):
-        for r in self.roles:
-            if r.reaction == react:
-                return r
+        return self.roles.get(react)
 
     def all_except(self, role):
-        return [r for r in self.roles if r != role]
+        return [r for r in self.roles.values() if r != role]
 
 
 class ReactionTypeConverter(commands.Converter):
@@ -98,12 +127,67 @@ class ReactionRoles(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        # Every reaction role message by message ID, so reactions on anything else are thrown out right away
+        self.index = {}
+        self.index_ready = False
+        # Set after the first attempt at loading, whether it worked or not
+        self.loaded = asyncio.Event()
+        self._load_task = self.bot.loop.create_task(self.load_index())
+
+    def cog_unload(self):
+        self._load_task.cancel()
+
+    @staticmethod
+    def build_index(entries):
+        index = {}
+        for entry in entries:
+            indexed = index.get(entry['message_id'])
+            if indexed is None:
+                indexed = IndexedMessage(entry['guild_id'], entry['channel_id'], entry['type'])
+                index[entry['message_id']] = indexed
+            if entry['reaction'] is not None:
+                indexed.roles[entry['reaction']] = entry['role_id']
+        return index
+
+    async def load_index(self):
+        delay = 5
+        while True:
+            try:
+                async with db.MaybeAcquire(pool=self.bot.pool) as con:
+                    entries = await con.fetch(ALL_REACTION_ROLES + ';')
+            except Exception:
+                logging.exception('Could not load reaction roles, trying again in {0} seconds'.format(delay))
+            else:
+                self.index = self.build_index(entries)
+                self.index_ready = True
+                return
+            finally:
+                self.loaded.set()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300)
+
+    async def is_reaction_message(self, message_id):
+        if not self.loaded.is_set():
+            await self.loaded.wait()
+        if not self.index_ready:
+            # Can't tell yet, so let the database decide
+            return True
+        return message_id in self.index
+
+    async def get_indexed(self, guild_id, message_id):
+        if self.index_ready:
+            return self.index.get(message_id)
+        async with db.MaybeAcquire(pool=self.bot.pool) as con:
+            entries = await GET_REACTION_MESSAGE.fetch(con, guild_id, message_id)
+        return self.build_index(entries).get(message_id)
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
         guild = payload.guild_id
         if guild is None:
             return
+        if not await self.is_reaction_message(payload.message_id):
+            return
         user = payload.member
         if user.bot:
             # No reaction roles for bot..
@@ -120,6 +204,8 @@ class ReactionRoles(commands.Cog):
         guild = payload.guild_id
         if guild is None:
             return
+        if not await self.is_reaction_message(payload.message_id):
+            return
         user = payload.member
         if user is None:
             guild_obj = self.bot.get_guild(guild)
@@ -141,6 +227,8 @@ class ReactionRoles(commands.Cog):
     async def handle_reaction(self, add, user, roles, reaction):
         user: discord.Member
         role = roles.get_react(reaction)
+        if role is None:
+            return
         if roles.reaction_type == ReactionType.toggle:
             if add:
                 await user.add_roles(role.role, reason='Reaction')
@@ -148,16 +236,17 @@ class ReactionRoles(commands.Cog):
                 await user.remove_roles(role.role, reason='Reaction')
         elif roles.reaction_type == ReactionType.once:
             if add:
-                for message_reaction in roles.message.reactions:
-                    if str(message_reaction.emoji) != reaction:
-                        await roles.message.remove_reaction(message_reaction.emoji, user)
+                if roles.message is not None:
+                    for message_reaction in roles.message.reactions:
+                        if str(message_reaction.emoji) != reaction:
+                            await roles.message.remove_reaction(message_reaction.emoji, user)
 
                 await user.add_roles(role.role, reason='Reaction')
             else:
                 await user.remove_roles(role.role, reason='Reaction')
 
     # MPL v2 https://github.com/Rapptz/RoboDanny/blob/rewrite/cogs/stars.py#L203
-    @cache.cache()
+    @cache.cache(maxsize=128)
     async def get_message(self, channel, message_id):
         try:
             o = discord.Object(id=message_id + 1)
@@ -239,43 +328,36 @@ class ReactionRoles(commands.Cog):
             message_entry = await con.fetchrow(select)
             insert = insert.format(message_entry['reaction_role_id'], role_id)
             await con.execute(insert, str(reaction))
-        self.get_reaction_roles.invalidate(self, guild_id, message_id)
+        indexed = self.index.get(message_id)
+        if indexed is None:
+            indexed = IndexedMessage(guild_id, channel_id, reaction_index)
+            self.index[message_id] = indexed
+        # Same as the conflicts above, an existing reaction or role is left alone
+        if str(reaction) not in indexed.roles and role_id not in indexed.roles.values():
+            indexed.roles[str(reaction)] = role_id
 
-    @cache.cache()
     async def get_reaction_roles(self, guild_id, message_id):
+        indexed = await self.get_indexed(guild_id, message_id)
+        if indexed is None or indexed.guild_id != guild_id or not indexed.roles:
+            return None
         guild = self.bot.get_guild(guild_id)
         if guild is None:
             return None
-
-        check_command = 'SELECT * FROM reaction_messages WHERE guild_id = {0} and message_id = {1};'
-        roles_command = 'SELECT * FROM reaction_roles WHERE reaction_role_id = {0};'
-
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            entry = await con.fetchrow(check_command.format(guild_id, message_id))
-            if entry is None:
-                # Not a reaction message
-                return None
-            roles_entry = await con.fetch(roles_command.format(entry['reaction_role_id']))
-
-        if len(roles_entry) == 0:
-            # No reaction roles
+        channel = guild.get_channel(indexed.channel_id)
+        if channel is None:
             return None
 
-        roles = []
-        for role_entry in roles_entry:
-            role = guild.get_role(role_entry['role_id'])
+        roles = {}
+        for reaction, role_id in indexed.roles.items():
+            role = guild.get_role(role_id)
             if role is None:
                 continue
-            roles.append(ReactionRole(role_entry['reaction'], role))
-        try:
-            reaction_type = ReactionType(entry['type'])
-        except ValueError:
-            reaction_type = ReactionType.toggle
-        channel = guild.get_channel(entry['channel_id'])
-        if channel is None:
-            return None
-        message = await self.get_message(channel, message_id)
-        return ReactionRolesContainer(guild, channel, message, roles, reaction_type)
+            roles[reaction] = ReactionRole(reaction, role)
+        message = None
+        if indexed.reaction_type == ReactionType.once:
+            # Only needed to take off the other reactions
+            message = await self.get_message(channel, message_id)
+        return ReactionRolesContainer(guild, channel, message, roles, indexed.reaction_type)
 
 
 def setup(bot):
@@ -1,7 +1,13 @@
+from bot.cogs.stats.channels.channel_base import TYPES
+from bot.cogs.stats.channels.members_channel import MemberStatChannel
 from bot.cogs.stats.channels.messages_channel import MessageStatChannel
+from bot.cogs.stats.channels.top_channel import TopChannelStatChannel
 from bot.cogs.stats.channels.voice_channel import VoiceStatChannel
 
 __all__ = [
+    'TYPES',
+    'MemberStatChannel',
     'MessageStatChannel',
-    'VoiceStatChannel'
+    'TopChannelStatChannel',
+    'VoiceStatChannel',
 ]
@@ -1,16 +1,118 @@
+import re
+from datetime import timedelta
+
 from glocklib import context as Context
+from glocklib import database as db
+
+# Every stat channel type by the number stored in stat_channels.type
+TYPES = {}
+
+
+def register(cls):
+    TYPES[cls.channel_type] = cls()
+    return cls
 
 
 class StatChannel:
+    channel_type = None
+    example = '{0}'
 
-    async def name_from_sql(self, guild_id, channel_id, name, text, connection) -> str:
-        raise NotImplementedError
+    def parse(self, text):
+        """Turns the arguments column into the setting values are fetched for. Has to be hashable."""
+        return None
+
+    async def ask_arguments(self, ctx: Context):
+        """Asks for anything the channel needs stored in arguments. None cancels."""
+        return ''
 
-    async def create(self, ctx: Context, channel) -> str:
+    async def fetch_values(self, bot, guild_ids, setting, connection) -> dict:
+        """Gets the value for every guild in one go. Guilds that are missing are treated as having nothing."""
         raise NotImplementedError
 
+    def format_value(self, value, setting) -> str:
+        return str(value or 0)
+
+    async def values(self, bot, entries, connection):
+        """Gets the formatted value of every entry, keyed by (guild_id, arguments)."""
+        by_setting = {}
+        for entry in entries:
+            by_setting.setdefault(self.parse(entry['arguments']), set()).add(entry['guild_id'])
+        values = {}
+        # One fetch for every distinct setting instead of every channel
+        for setting, guild_ids in by_setting.items():
+            fetched = await self.fetch_values(bot, list(guild_ids), setting, connection)
+            for guild_id in guild_ids:
+                values[(guild_id, setting)] = self.format_value(fetched.get(guild_id), setting)
+        return {
+            (entry['guild_id'], entry['arguments']): values[(entry['guild_id'], self.parse(entry['arguments']))]
+            for entry in entries
+        }
+
+    async def create(self, ctx: Context, channel):
+        description = ('What name would you like the channel to have? '
+                       'Use `{0}` for the number placeholder.\n\nExamples:'
+                       '```\n{1}\n```').format('{0}', self.example)
+        name = await ctx.ask(embed=ctx.create_embed(description))
+        if name is None:
+            return await ctx.send(embed=ctx.create_embed(description='Cancelled!', error=True))
+        if '{0}' not in name:
+            return await ctx.send(embed=ctx.create_embed(description='Channel name has to contain `{0}`!', error=True))
+        if len(name) > 50:
+            return await ctx.send(embed=ctx.create_embed(description="Channel name can't be over 50 characters!", error=True))
+        arguments = await self.ask_arguments(ctx)
+        if arguments is None:
+            return await ctx.send(embed=ctx.create_embed(description='Cancelled!', error=True))
+        command = "INSERT INTO stat_channels(guild_id, channel_id, type, name, arguments) VALUES ({0}, {1}, {2}, $1, $2);"
+        command = command.format(ctx.guild.id, channel.id, self.channel_type)
+        async with db.MaybeAcquire(pool=ctx.bot.pool) as con:
+            await con.execute(command, name, arguments)
+        info = await self.get_info(ctx.guild.id, channel.id, name, arguments)
+        await ctx.send(embed=ctx.create_embed('Created new stat channel!\n\n{0}'.format(info)))
+
     async def get_info(self, guild_id, channel_id, name, text):
         raise NotImplementedError
 
     def get_standard_description(self):
         raise NotImplementedError
+
+
+class WindowedStatChannel(StatChannel):
+    """A stat channel that counts over a window of time stored in arguments as hours."""
+
+    WINDOW_REGEX = re.compile(r'(\d{1,3})\s*(h|hours?|d|days?)$')
+    # Channels from before windows were stored don't have arguments
+    default_window = 24
+    max_window = 30 * 24
+
+    def parse(self, text):
+        try:
+            hours = int(text)
+        except (TypeError, ValueError):
+            hours = self.default_window
+        return timedelta(hours=hours)
+
+    async def ask_arguments(self, ctx: Context):
+        result = await ctx.ask(embed=ctx.create_embed(
+            'How far back should it count? Use hours or days, up to 30 days.\n\nExamples:```\n24 hours\n7 days\n```',
+        ))
+        if result is None:
+            return None
+        match = self.WINDOW_REGEX.match(result.strip().lower())
+        if match is None:
+            await ctx.send(embed=ctx.create_embed('`{0}` is not a proper amount of time!'.format(result), error=True))
+            return None
+        hours = int(match.group(1))
+        if match.group(2).startswith('d'):
+            hours *= 24
+        if hours <= 0 or hours > self.max_window:
+            await ctx.send(embed=ctx.create_embed('Time has to be above zero and at most 30 days!', error=True))
+            return None
+        return str(hours)
+
+    def window_description(self, text):
+        hours = int(self.parse(text).total_seconds() // 3600)
+        if hours == 24:
+            return 'the last day'
+        if hours % 24 == 0:
+            return 'the last {0} days'.format(hours // 24)
+        return 'the last {0} hours'.format(hours)
@@ -0,0 +1,51 @@
+from glocklib import context as Context
+
+from bot.cogs.stats.channels.channel_base import StatChannel, register
+
+KINDS = ('total', 'humans', 'bots')
+
+
+@register
+class MemberStatChannel(StatChannel):
+    """Counted from the member cache, so it never touches the database."""
+    channel_type = 0
+    example = '{0} Members\nMembers: {0}'
+
+    def parse(self, text):
+        if text in KINDS:
+            return text
+        return 'total'
+
+    async def ask_arguments(self, ctx: Context):
+        result = await ctx.ask(embed=ctx.create_embed(
+            'What members should it count? `total`, `humans`, or `bots`',
+        ))
+        if result is None:
+            return None
+        result = result.strip().lower()
+        if result not in KINDS:
+            await ctx.send(embed=ctx.create_embed('`{0}` is not total, humans, or bots!'.format(result), error=True))
+            return None
+        return result
+
+    async def fetch_values(self, bot, guild_ids, setting, connection) -> dict:
+        values = {}
+        for guild_id in guild_ids:
+            guild = bot.get_guild(guild_id)
+            if guild is None:
+                continue
+            if setting == 'total':
+                values[guild_id] = guild.member_count
+                continue
+            bots = sum(1 for member in guild.members if member.bot)
+            values[guild_id] = bots if setting == 'bots' else guild.member_count - bots
+        return values
+
+    async def get_info(self, guild_id, channel_id, name, text):
+        kind = self.parse(text)
+        if kind == 'total':
+            return '<#{0}> - Amount of members'.format(channel_id)
+        return '<#{0}> - Amount of {1}'.format(channel_id, kind)
+
+    def get_standard_description(self):
+        return 'A channel to display the amount of members, humans, or bots.'
@@ -1,46 +1,39 @@
-from bot.cogs.stats.channels.channel_base import StatChannel
-from glocklib import context as Context
-from glocklib import database as db
+from datetime import timedelta
 
+from bot.cogs.stats import messages
+from bot.cogs.stats import queries
+from bot.cogs.stats.channels.channel_base import WindowedStatChannel, register
+from bot.util import statements
 
-class MessageStatChannel(StatChannel):
+# One statement for every rollup a window could land in
+MESSAGES_WINDOW = {
+    rollup.table: statements.register(
+        'stat_channel_messages_{0}'.format(rollup.table),
+        "SELECT guild_id, SUM(amount) AS amount FROM {1} WHERE {0} AND time >= NOW() at time zone 'utc' - $2::interval "
+        "GROUP BY guild_id;".format(
+            queries.where('guild_id = ANY($1::bigint[])', rollup.filter(queries.COUNTED)), rollup.table,
+        ),
+    )
+    for rollup in queries.ROLLUPS
+}
 
-    def __init__(self):
-        self.channel_type = 1
 
-    async def name_from_sql(self, guild_id, channel_id, name, text, connection) -> str:
-        command = "SELECT * FROM messages WHERE guild_id = {0} AND time >= NOW() at time zone 'utc' - INTERVAL '24 HOURS';"
-        command = command.format(guild_id)
-        entries = await connection.fetch(command)
-        i = 0
-        for entry in entries:
-            if entry['channel_id'] is None and entry['user_id'] is None:
-                i += entry['amount']
-            elif entry['channel_id'] is not None:
-                i += entry['amount']
-        return name.replace('{0}', str(i))
+@register
+class MessageStatChannel(WindowedStatChannel):
+    channel_type = 1
+    example = '{0} Messages\nTotal of {0}'
 
-    async def create(self, ctx: Context, channel):
-        description = ('What name would you like the channel to have? '
-                       'Use `{0}` for the number placeholder.\n\nExamples:'
-                       '```\n{0} Messages\nTotal of {0}\n```')
-        name = await ctx.ask(embed=ctx.create_embed(description))
-        if name is None:
-            return await ctx.send(embed=ctx.create_embed(description='Cancelled!', error=True))
-        if '{0}' not in name:
-            return await ctx.send(embed=ctx.create_embed(description='Channel name has to contain `{0}`!', error=True))
-        if len(name) > 50:
-            return await ctx.send(embed=ctx.create_embed(description="Channel name can't be over 50 characters!", error=True))
-        command = "INSERT INTO stat_channels(guild_id, channel_id, type, name) VALUES ({0}, {1}, {2}, $1);"
-        command = command.format(ctx.guild.id, channel.id, self.channel_type)
-        arguments = ''
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            await con.execute(command, name)
-        info = await self.get_info(ctx.guild.id,channel.id, name, arguments)
-        await ctx.send(embed=ctx.create_embed('Created new stat channel!\n\n{0}'.format(info)))
+    async def fetch_values(self, bot, guild_ids, setting, connection) -> dict:
+        rolling = messages.get_rolling(bot)
+        if rolling is not None and setting == timedelta(days=1):
+            # Counted live, so the last day doesn't need the database at all
+            return {guild_id: rolling.get(guild_id) for guild_id in guild_ids}
+        rollup = queries.choose_rollup(setting, detailed=False)
+        entries = await MESSAGES_WINDOW[rollup.table].fetch(connection, guild_ids, setting)
+        return {entry['guild_id']: entry['amount'] for entry in entries}
 
     async def get_info(self, guild_id, channel_id, name, text):
-        return '<#{0}> - Messages in the last day'.format(channel_id)
+        return '<#{0}> - Messages in {1}'.format(channel_id, self.window_description(text))
 
     def get_standard_description(self):
         return 'A channel to display the amount of messages in a set time period.'
@@ -0,0 +1,39 @@
+from bot.cogs.stats import queries
+from bot.cogs.stats.channels.channel_base import WindowedStatChannel, register
+from bot.util import statements
+
+# Needs channel information, so only the detailed rollups work
+TOP_WINDOW = {
+    rollup.table: statements.register(
+        'stat_channel_top_{0}'.format(rollup.table),
+        "SELECT DISTINCT ON (guild_id) guild_id, channel_id, SUM(amount) AS amount FROM {0} "
+        "WHERE guild_id = ANY($1::bigint[]) AND channel_id IS NOT NULL "
+        "AND time >= NOW() at time zone 'utc' - $2::interval "
+        "GROUP BY guild_id, channel_id ORDER BY guild_id, amount DESC;".format(rollup.table),
+    )
+    for rollup in queries.ROLLUPS if rollup.detailed
+}
+
+
+@register
+class TopChannelStatChannel(WindowedStatChannel):
+    channel_type = 3
+    example = 'Top: {0}\nMost active: {0}'
+
+    async def fetch_values(self, bot, guild_ids, setting, connection) -> dict:
+        rollup = queries.choose_rollup(setting)
+        entries = await TOP_WINDOW[rollup.table].fetch(connection, guild_ids, setting)
+        values = {}
+        for entry in entries:
+            channel = bot.get_channel(entry['channel_id'])
+            values[entry['guild_id']] = channel.name if channel is not None else 'deleted-channel'
+        return values
+
+    def format_value(self, value, setting) -> str:
+        return value or 'none'
+
+    async def get_info(self, guild_id, channel_id, name, text):
+        return '<#{0}> - Most active channel in {1}'.format(channel_id, self.window_description(text))
+
+    def get_standard_description(self):
+        return 'A channel to display the channel with the most messages in a set time period.'
@@ -1,44 +1,30 @@
-from bot.cogs.stats.channels.channel_base import StatChannel
-from glocklib import context as Context
-from glocklib import database as db
+from bot.cogs.stats.channels.channel_base import WindowedStatChannel, register
+from bot.cogs.stats import queries
+from bot.util import statements
 from bot.util import time_util as tutil
 
+VOICE_WINDOW = statements.register(
+    'stat_channel_voice',
+    "SELECT guild_id, EXTRACT(EPOCH FROM SUM(amount)) AS seconds FROM voice "
+    "WHERE guild_id = ANY($1::bigint[]) AND {0} AND {1} "
+    "GROUP BY guild_id;".format(queries.COUNTED, queries.voice_since("NOW() at time zone 'utc' - $2::interval")),
+)
 
-class VoiceStatChannel(StatChannel):
 
-    def __init__(self):
-        self.channel_type = 2
+@register
+class VoiceStatChannel(WindowedStatChannel):
+    channel_type = 2
+    example = '{0} Time in VC\nTotal of {0}'
 
-    async def name_from_sql(self, guild_id, channel_id, name, text, connection) -> str:
-        command = "SELECT * FROM voice WHERE guild_id = {0} AND time + amount >= NOW() at time zone 'utc' - INTERVAL '{1}';"
-        command = command.format(guild_id, '1 DAY')
-        entries = await connection.fetch(command)
-        i = 0
-        for entry in entries:
-            i += entry['amount'].total_seconds()
-        return name.replace('{0}', tutil.human_digital(i))
+    async def fetch_values(self, bot, guild_ids, setting, connection) -> dict:
+        entries = await VOICE_WINDOW.fetch(connection, guild_ids, setting)
+        return {entry['guild_id']: entry['seconds'] for entry in entries}
 
-    async def create(self, ctx: Context, channel):
-        description = ('What name would you like the channel to have? '
-                       'Use `{0}` for the number placeholder.\n\nExamples:'
-                       '```\n{0} Time in VC\nTotal of {0}\n```')
-        name = await ctx.ask(embed=ctx.create_embed(description))
-        if name is None:
-            return await ctx.send(embed=ctx.create_embed(description='Cancelled!', error=True))
-        if '{0}' not in name:
-            return await ctx.send(embed=ctx.create_embed(description='Channel name has to contain `{0}`!', error=True))
-        if len(name) > 50:
-            return await ctx.send(embed=ctx.create_embed(description="Channel name can't be over 50 characters!", error=True))
-        command = "INSERT INTO stat_channels(guild_id, channel_id, type, name) VALUES ({0}, {1}, {2}, $1);"
-        command = command.format(ctx.guild.id, channel.id, self.channel_type)
-        arguments = ''
-        async with db.MaybeAcquire(pool=ctx.bot.pool) as con:
-            await con.execute(command, name)
-        info = await self.get_info(ctx.guild.id, channel.id, name, arguments)
-        await ctx.send(embed=ctx.create_embed('Created new stat channel!\n\n{0}'.format(info)))
+    def format_value(self, value, setting) -> str:
+        return tutil.human_digital(float(value or 0))
 
     async def get_info(self, guild_id, channel_id, name, text):
-        return '<#{0}> - Time in voice in the past day.'.format(channel_id)
+        return '<#{0}> - Time in voice in {1}.'.format(channel_id, self.window_description(text))
 
     def get_standard_description(self):
         return 'A channel to display the total amount of time spent in voice chat in a set time period.'
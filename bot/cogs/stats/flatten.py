@@ -0,0 +1,381 @@
+"""
+Flattens old message and voice data inside of PostgreSQL.
+
+Each pass is one statement that deletes aged rows and inserts the grouped result from the deleted rows, so nothing
+gets sent back to the bot other than how many rows were changed per guild.
+"""
+import asyncio
+import logging
+import time
+from collections import Counter
+
+from glocklib import database as db
+
+
+class FlattenProgressTable(db.Table, table_name='flatten_progress'):
+    guild_id = db.Column(db.Integer(big=True), unique=True, index=True, nullable=False)
+    day = db.Column(db.Date(), nullable=False)
+
+
+SPECIFIC = """
+WITH settings(guild_id, days) AS (VALUES {0}),
+deleted AS (
+    DELETE FROM messages USING settings
+    WHERE messages.guild_id = settings.guild_id AND messages.channel_id IS NOT NULL AND messages.user_id IS NOT NULL
+    AND messages.time <= NOW() at time zone 'utc' - settings.days * INTERVAL '1 DAY'
+    RETURNING messages.*
+),
+inserted AS (
+    INSERT INTO messages(guild_id, channel_id, user_id, amount, time, interval)
+    SELECT guild_id, channel_id, NULL, SUM(amount), time, interval FROM deleted
+    GROUP BY guild_id, channel_id, time, interval
+    UNION ALL
+    SELECT guild_id, NULL, user_id, SUM(amount), time, interval FROM deleted
+    GROUP BY guild_id, user_id, time, interval
+    ON CONFLICT ON CONSTRAINT unique_message DO UPDATE SET amount = messages.amount + EXCLUDED.amount
+    RETURNING guild_id
+)
+{1}
+"""
+
+# Rows that are already a day long don't need to be touched again
+TIME = """
+WITH settings(guild_id, days) AS (VALUES {0}),
+deleted AS (
+    DELETE FROM messages USING settings
+    WHERE messages.guild_id = settings.guild_id AND (messages.channel_id IS NOT NULL OR messages.user_id IS NOT NULL)
+    AND messages.interval < INTERVAL '1 DAY'
+    AND messages.time <= NOW() at time zone 'utc' - settings.days * INTERVAL '1 DAY'
+    RETURNING messages.*
+),
+inserted AS (
+    INSERT INTO messages(guild_id, channel_id, user_id, amount, time, interval)
+    SELECT guild_id, channel_id, NULL, SUM(amount), date_trunc('day', time), INTERVAL '1 DAY' FROM deleted
+    WHERE channel_id IS NOT NULL GROUP BY guild_id, channel_id, date_trunc('day', time)
+    UNION ALL
+    SELECT guild_id, NULL, user_id, SUM(amount), date_trunc('day', time), INTERVAL '1 DAY' FROM deleted
+    WHERE user_id IS NOT NULL GROUP BY guild_id, user_id, date_trunc('day', time)
+    ON CONFLICT ON CONSTRAINT unique_message DO UPDATE SET amount = messages.amount + EXCLUDED.amount
+    RETURNING guild_id
+)
+{1}
+"""
+
+# Rows that only have the guild are already flattened, so they're left alone
+DETAILS = """
+WITH settings(guild_id, days) AS (VALUES {0}),
+deleted AS (
+    DELETE FROM messages USING settings
+    WHERE messages.guild_id = settings.guild_id AND (messages.channel_id IS NOT NULL OR messages.user_id IS NOT NULL)
+    AND messages.time <= NOW() at time zone 'utc' - settings.days * INTERVAL '1 DAY'
+    RETURNING messages.*
+),
+inserted AS (
+    INSERT INTO messages(guild_id, amount, time, interval)
+    SELECT guild_id, SUM(amount), time, interval FROM deleted
+    WHERE channel_id IS NOT NULL GROUP BY guild_id, time, interval
+    ON CONFLICT ON CONSTRAINT unique_message DO UPDATE SET amount = messages.amount + EXCLUDED.amount
+    RETURNING guild_id
+)
+{1}
+"""
+
+DAILY_SPECIFIC = """
+WITH settings(guild_id, days) AS (VALUES {0}),
+deleted AS (
+    DELETE FROM messages_daily USING settings
+    WHERE messages_daily.guild_id = settings.guild_id
+    AND messages_daily.channel_id IS NOT NULL AND messages_daily.user_id IS NOT NULL
+    AND messages_daily.time <= NOW() at time zone 'utc' - settings.days * INTERVAL '1 DAY'
+    RETURNING messages_daily.*
+),
+inserted AS (
+    INSERT INTO messages_daily(guild_id, channel_id, user_id, time, amount)
+    SELECT guild_id, channel_id, NULL, time, SUM(amount) FROM deleted GROUP BY guild_id, channel_id, time
+    UNION ALL
+    SELECT guild_id, NULL, user_id, time, SUM(amount) FROM deleted GROUP BY guild_id, user_id, time
+    ON CONFLICT (guild_id, COALESCE(channel_id, 0), COALESCE(user_id, 0), time)
+    DO UPDATE SET amount = messages_daily.amount + EXCLUDED.amount
+    RETURNING guild_id
+)
+{1}
+"""
+
+DAILY_DETAILS = """
+WITH settings(guild_id, days) AS (VALUES {0}),
+deleted AS (
+    DELETE FROM messages_daily USING settings
+    WHERE messages_daily.guild_id = settings.guild_id
+    AND (messages_daily.channel_id IS NOT NULL OR messages_daily.user_id IS NOT NULL)
+    AND messages_daily.time <= NOW() at time zone 'utc' - settings.days * INTERVAL '1 DAY'
+    RETURNING messages_daily.*
+),
+inserted AS (
+    INSERT INTO messages_daily(guild_id, time, amount)
+    SELECT guild_id, time, SUM(amount) FROM deleted WHERE channel_id IS NOT NULL GROUP BY guild_id, time
+    ON CONFLICT (guild_id, COALESCE(channel_id, 0), COALESCE(user_id, 0), time)
+    DO UPDATE SET amount = messages_daily.amount + EXCLUDED.amount
+    RETURNING guild_id
+)
+{1}
+"""
+
+# The hourly rollup loses its hours once the guild's raw messages do. Rows already at midnight are left where they
+# are so nothing gets deleted and updated in the same statement.
+HOURLY_TIME = """
+WITH settings(guild_id, days) AS (VALUES {0}),
+deleted AS (
+    DELETE FROM messages_hourly USING settings
+    WHERE messages_hourly.guild_id = settings.guild_id
+    AND messages_hourly.time <> date_trunc('day', messages_hourly.time)
+    AND messages_hourly.time <= NOW() at time zone 'utc' - settings.days * INTERVAL '1 DAY'
+    RETURNING messages_hourly.*
+),
+inserted AS (
+    INSERT INTO messages_hourly(guild_id, time, amount)
+    SELECT guild_id, date_trunc('day', time), SUM(amount) FROM deleted GROUP BY guild_id, date_trunc('day', time)
+    ON CONFLICT ON CONSTRAINT unique_message_hour DO UPDATE SET amount = messages_hourly.amount + EXCLUDED.amount
+    RETURNING guild_id
+)
+{1}
+"""
+
+# Voice rows only have one row per key, so conflicts go through the expression index that ignores nulls
+VOICE_SPECIFIC = """
+WITH settings(guild_id, days) AS (VALUES {0}),
+deleted AS (
+    DELETE FROM voice USING settings
+    WHERE voice.guild_id = settings.guild_id AND voice.channel_id IS NOT NULL AND voice.user_id IS NOT NULL
+    AND voice.time <= NOW() at time zone 'utc' - settings.days * INTERVAL '1 DAY'
+    RETURNING voice.*
+),
+inserted AS (
+    INSERT INTO voice(guild_id, channel_id, user_id, time, amount, interval)
+    SELECT guild_id, channel_id, NULL, date_trunc('hour', time), SUM(amount), INTERVAL '1 HOUR' FROM deleted
+    GROUP BY guild_id, channel_id, date_trunc('hour', time)
+    UNION ALL
+    SELECT guild_id, NULL, user_id, date_trunc('hour', time), SUM(amount), INTERVAL '1 HOUR' FROM deleted
+    GROUP BY guild_id, user_id, date_trunc('hour', time)
+    ON CONFLICT (guild_id, COALESCE(channel_id, 0), COALESCE(user_id, 0), time)
+    DO UPDATE SET amount = voice.amount + EXCLUDED.amount
+    RETURNING guild_id
+)
+{1}
+"""
+
+VOICE_TIME = """
+WITH settings(guild_id, days) AS (VALUES {0}),
+deleted AS (
+    DELETE FROM voice USING settings
+    WHERE voice.guild_id = settings.guild_id AND (voice.channel_id IS NOT NULL OR voice.user_id IS NOT NULL)
+    AND voice.interval < INTERVAL '1 DAY'
+    AND voice.time <= NOW() at time zone 'utc' - settings.days * INTERVAL '1 DAY'
+    RETURNING voice.*
+),
+inserted AS (
+    INSERT INTO voice(guild_id, channel_id, user_id, time, amount, interval)
+    SELECT guild_id, channel_id, NULL, date_trunc('day', time), SUM(amount), INTERVAL '1 DAY' FROM deleted
+    WHERE channel_id IS NOT NULL GROUP BY guild_id, channel_id, date_trunc('day', time)
+    UNION ALL
+    SELECT guild_id, NULL, user_id, date_trunc('day', time), SUM(amount), INTERVAL '1 DAY' FROM deleted
+    WHERE user_id IS NOT NULL GROUP BY guild_id, user_id, date_trunc('day', time)
+    ON CONFLICT (guild_id, COALESCE(channel_id, 0), COALESCE(user_id, 0), time)
+    DO UPDATE SET amount = voice.amount + EXCLUDED.amount
+    RETURNING guild_id
+)
+{1}
+"""
+
+VOICE_DETAILS = """
+WITH settings(guild_id, days) AS (VALUES {0}),
+deleted AS (
+    DELETE FROM voice USING settings
+    WHERE voice.guild_id = settings.guild_id AND (voice.channel_id IS NOT NULL OR voice.user_id IS NOT NULL)
+    AND voice.time <= NOW() at time zone 'utc' - settings.days * INTERVAL '1 DAY'
+    RETURNING voice.*
+),
+inserted AS (
+    INSERT INTO voice(guild_id, time, amount, interval)
+    SELECT guild_id, time, SUM(amount), MAX(interval) FROM deleted
+    WHERE channel_id IS NOT NULL GROUP BY guild_id, time
+    ON CONFLICT (guild_id, COALESCE(channel_id, 0), COALESCE(user_id, 0), time)
+    DO UPDATE SET amount = voice.amount + EXCLUDED.amount
+    RETURNING guild_id
+)
+{1}
+"""
+
+# How many rows were removed and added for each guild
+REPORT = """
+SELECT guild_id, COUNT(*) AS removed, (
+    SELECT COUNT(*) FROM inserted WHERE inserted.guild_id = deleted.guild_id
+) AS added FROM deleted GROUP BY guild_id;
+"""
+
+# Pass name, statement and the guild setting it uses
+PASSES = (
+    ('specific', SPECIFIC, 'specific'),
+    ('time', TIME, 'time'),
+    ('detail', DETAILS, 'detail'),
+    ('daily_specific', DAILY_SPECIFIC, 'specific'),
+    ('daily_detail', DAILY_DETAILS, 'detail'),
+    ('hourly_time', HOURLY_TIME, 'time'),
+    ('voice_specific', VOICE_SPECIFIC, 'specific'),
+    ('voice_time', VOICE_TIME, 'time'),
+    ('voice_detail', VOICE_DETAILS, 'detail'),
+)
+
+
+class FlattenReport:
+    """Rows changed and time taken while flattening."""
+
+    def __init__(self):
+        self.removed = Counter()
+        self.added = Counter()
+        self.durations = Counter()
+        self.statements = 0
+
+    def add(self, guild_ids, entries, duration):
+        self.statements += 1
+        for entry in entries:
+            self.removed[entry['guild_id']] += entry['removed']
+            self.added[entry['guild_id']] += entry['added']
+        # Guilds in a batch share one statement, so they share the time it took
+        for guild_id in guild_ids:
+            self.durations[guild_id] += duration / len(guild_ids)
+
+    def total_removed(self):
+        return sum(self.removed.values())
+
+    def total_added(self):
+        return sum(self.added.values())
+
+    def total_duration(self):
+        return sum(self.durations.values())
+
+    def log(self):
+        for guild_id, duration in self.durations.most_common():
+            logging.info('Flattened guild {0} in {1:.3f}s ({2} rows removed, {3} rows added)'.format(
+                guild_id, duration, self.removed[guild_id], self.added[guild_id],
+            ))
+        logging.info('Flattened {0} guilds with {1} statements, {2} rows removed, {3} rows added in {4:.3f}s'.format(
+            len(self.durations), self.statements, self.total_removed(), self.total_added(), self.total_duration(),
+        ))
+
+
+class MessageFlattener:
+    """
+    Runs every flatten pass over guilds in batches.
+
+    Settings are a dictionary of guild ID to a dictionary containing `specific`, `time`, and `detail` days.
+    """
+
+    def __init__(self, *, batch_size=50, passes=PASSES):
+        self.batch_size = batch_size
+        self.passes = passes
+
+    @staticmethod
+    def batch_command(command, guild_settings, setting):
+        values = ', '.join('({0}::bigint, {1})'.format(guild_id, int(days[setting])) for guild_id, days in guild_settings)
+        return command.format(values, REPORT)
+
+    def batches(self, settings):
+        items = list(settings.items())
+        for index in range(0, len(items), self.batch_size):
+            yield items[index:index + self.batch_size]
+
+    async def flatten_batch(self, con, batch, report):
+        guild_ids = [guild_id for guild_id, _ in batch]
+        for _, command, setting in self.passes:
+            start = time.perf_counter()
+            entries = await con.fetch(self.batch_command(command, batch, setting))
+            report.add(guild_ids, entries, time.perf_counter() - start)
+        return report
+
+    async def flatten(self, con, settings, *, report=None):
+        """Flattens every guild in one transaction."""
+        if report is None:
+            report = FlattenReport()
+        if not settings:
+            return report
+        async with con.transaction():
+            for batch in self.batches(settings):
+                await self.flatten_batch(con, batch, report)
+        return report
+
+
+class FlattenScheduler:
+    """
+    Flattens batches of guilds at the same time using a limited amount of connections.
+
+    Every batch is committed along with a checkpoint for its guilds, so if the bot stops part of the way through the
+    guilds that were already done for the day are skipped next time.
+    """
+
+    checkpoint = (
+        'INSERT INTO flatten_progress(guild_id, day) VALUES {0} '
+        'ON CONFLICT (guild_id) DO UPDATE SET day = EXCLUDED.day;'
+    )
+
+    def __init__(self, pool, flattener, *, concurrency=4):
+        self.pool = pool
+        self.flattener = flattener
+        self.concurrency = concurrency
+        self.running = False
+        self.total = 0
+        self.completed = 0
+        self.report = None
+
+    async def get_pending(self, settings, day):
+        command = 'SELECT guild_id FROM flatten_progress WHERE day >= $1;'
+        async with db.MaybeAcquire(pool=self.pool) as con:
+            entries = await con.fetch(command, day)
+        done = {entry['guild_id'] for entry in entries}
+        return {guild_id: setting for guild_id, setting in settings.items() if guild_id not in done}
+
+    async def has_started(self, day):
+        """Whether a run on this day has already checkpointed a guild."""
+        command = 'SELECT 1 FROM flatten_progress WHERE day >= $1 LIMIT 1;'
+        async with db.MaybeAcquire(pool=self.pool) as con:
+            return await con.fetchrow(command, day) is not None
+
+    async def _run_batch(self, semaphore, batch, day):
+        checkpoint = self.checkpoint.format(', '.join(
+            "({0}, DATE '{1}')".format(guild_id, day.isoformat()) for guild_id, _ in batch
+        ))
+        async with semaphore:
+            async with db.MaybeAcquire(pool=self.pool) as con:
+                async with con.transaction():
+                    await self.flattener.flatten_batch(con, batch, self.report)
+                    await con.execute(checkpoint)
+        self.completed += len(batch)
+        logging.info('Flatten progress {0}/{1} guilds'.format(self.completed, self.total))
+
+    async def run(self, settings, day):
+        """Flattens every guild that hasn't been done on this day."""
+        if self.running:
+            return None
+        self.running = True
+        self.report = FlattenReport()
+        try:
+            pending = await self.get_pending(settings, day)
+            self.total = len(pending)
+            self.completed = 0
+            semaphore = asyncio.Semaphore(self.concurrency)
+            start = time.perf_counter()
+            # Every batch has to finish before running is cleared, otherwise another run could overlap with it
+            results = await asyncio.gather(*[
+                self._run_batch(semaphore, batch, day) for batch in self.flattener.batches(pending)
+            ], return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    # Those guilds aren't checkpointed, so the next run picks them back up
+                    logging.error('Flatten batch failed', exc_info=result)
+            elapsed = time.perf_counter() - start
+        finally:
+            self.running = False
+        self.report.log()
+        logging.info('Compacted {0} rows in {1:.3f}s ({2:.1f} rows/s)'.format(
+            self.report.total_removed(), elapsed, self.report.total_removed() / max(elapsed, 0.001),
+        ))
+        return self.report
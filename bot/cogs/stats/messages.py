@@ -1,15 +1,22 @@
+import asyncio
 import datetime
+import logging
 from collections import Counter
 
 from glocklib import database as db
+import bot as bot_storage
 import bot.util.storage_cache as storage_cache
 import bot.util.time_util as tutil
 import discord
 
 from bot.cogs import guild_config
+from bot.util import bulk
+from bot.util.rolling import RollingCounter
+from bot.util.spill import SpillFile
+from bot.cogs.stats import flatten
 from bot.cogs.stats import stat_config
 from glocklib import context as Context
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 
 class MessagesTable(db.Table, table_name='messages'):
@@ -31,17 +38,156 @@ class MessagesTable(db.Table, table_name='messages'):
         return statement + '\n' + sql
 
 
+class MessagesHourlyTable(db.Table, table_name='messages_hourly'):
+    guild_id = db.Column(db.Integer(big=True), nullable=False)
+    time = db.Column(db.Datetime(), nullable=False, index=True)
+    amount = db.Column(db.Integer(), nullable=False, default='0')
+
+    @classmethod
+    def create_table(cls, *, overwrite=False):
+        statement = super().create_table(overwrite=overwrite)
+
+        sql = 'ALTER TABLE messages_hourly DROP CONSTRAINT IF EXISTS unique_message_hour;' \
+              'ALTER TABLE messages_hourly ADD CONSTRAINT unique_message_hour UNIQUE (guild_id, time);'
+
+        # Fill from data that was there before the rollup existed
+        backfill = "INSERT INTO messages_hourly(guild_id, time, amount) " \
+                   "SELECT guild_id, date_trunc('hour', time), SUM(amount) FROM messages " \
+                   "WHERE (channel_id IS NOT NULL OR user_id IS NULL) AND NOT EXISTS (SELECT 1 FROM messages_hourly) " \
+                   "GROUP BY guild_id, date_trunc('hour', time);"
+
+        return '{0}\n{1}\n{2}'.format(statement, sql, backfill)
+
+
+class MessagesDailyTable(db.Table, table_name='messages_daily'):
+    guild_id = db.Column(db.Integer(big=True), nullable=False)
+    channel_id = db.Column(db.Integer(big=True), nullable=True)
+    user_id = db.Column(db.Integer(big=True), nullable=True)
+    time = db.Column(db.Datetime(), nullable=False, index=True)
+    amount = db.Column(db.Integer(), nullable=False, default='0')
+
+    @classmethod
+    def create_table(cls, *, overwrite=False):
+        statement = super().create_table(overwrite=overwrite)
+
+        # Flattened rows have null channels/users, which a normal unique constraint wouldn't catch
+        sql = 'CREATE UNIQUE INDEX IF NOT EXISTS messages_daily_uniq_idx ' \
+              'ON messages_daily (guild_id, COALESCE(channel_id, 0), COALESCE(user_id, 0), time);'
+
+        backfill = "INSERT INTO messages_daily(guild_id, channel_id, user_id, time, amount) " \
+                   "SELECT guild_id, channel_id, user_id, date_trunc('day', time), SUM(amount) FROM messages " \
+                   "WHERE NOT EXISTS (SELECT 1 FROM messages_daily) " \
+                   "GROUP BY guild_id, channel_id, user_id, date_trunc('day', time);"
+
+        return '{0}\n{1}\n{2}'.format(statement, sql, backfill)
+
+
+class MessagesStagingTable(db.Table, table_name='messages_staging'):
+    guild_id = db.Column(db.Integer(big=True), nullable=False)
+    channel_id = db.Column(db.Integer(big=True), nullable=False)
+    user_id = db.Column(db.Integer(big=True), nullable=False)
+    time = db.Column(db.Datetime(), nullable=False)
+    amount = db.Column(db.Integer(), nullable=False)
+
+    @classmethod
+    def create_table(cls, *, overwrite=False):
+        # Nothing is left in here after a push commits, so it doesn't need to be crash safe
+        return bulk.unlogged(super().create_table(overwrite=overwrite))
+
+
+# Moves staged counts into the raw table and both rollups
+MERGE = """
+WITH moved AS (
+    DELETE FROM messages_staging RETURNING *
+),
+raw AS (
+    INSERT INTO messages(guild_id, channel_id, user_id, amount, time, interval)
+    SELECT guild_id, channel_id, user_id, SUM(amount), time, INTERVAL '30 MINUTES' FROM moved
+    GROUP BY guild_id, channel_id, user_id, time
+    ON CONFLICT ON CONSTRAINT unique_message DO UPDATE SET amount = messages.amount + EXCLUDED.amount
+),
+hourly AS (
+    INSERT INTO messages_hourly(guild_id, time, amount)
+    SELECT guild_id, date_trunc('hour', time), SUM(amount) FROM moved GROUP BY guild_id, date_trunc('hour', time)
+    ON CONFLICT ON CONSTRAINT unique_message_hour DO UPDATE SET amount = messages_hourly.amount + EXCLUDED.amount
+)
+INSERT INTO messages_daily(guild_id, channel_id, user_id, time, amount)
+SELECT guild_id, channel_id, user_id, date_trunc('day', time), SUM(amount) FROM moved
+GROUP BY guild_id, channel_id, user_id, date_trunc('day', time)
+ON CONFLICT (guild_id, COALESCE(channel_id, 0), COALESCE(user_id, 0), time)
+DO UPDATE SET amount = messages_daily.amount + EXCLUDED.amount;
+"""
+
+writer = bulk.StagedWriter('messages_staging', ('guild_id', 'channel_id', 'user_id', 'time', 'amount'), MERGE)
+
+
+# Guild totals for the last day to seed the rolling counters with
+RECENT_HOURLY = "SELECT guild_id, time, amount FROM messages_hourly WHERE time >= NOW() at time zone 'utc' - INTERVAL '24 HOURS';"
+
+
+def get_rolling(bot):
+    """Gets live message counts over the last day, or None if they aren't ready yet."""
+    cog = bot.get_cog('Messages')
+    if cog is None or not cog.rolling_ready:
+        return None
+    return cog.rolling
+
+
+async def write_messages(connection, counts):
+    """Writes a counter of (guild_id, channel_id, user_id, time) to amount."""
+    await writer.write(connection, [(*key, amount) for key, amount in counts.items()])
+
+
 class Messages(commands.Cog):
     """Tracks messages using the bot."""
 
     def __init__(self, bot):
         self.bot = bot
         self.bot.add_loop('messagepush', self.update_loop)
+        # (guild_id, channel_id, user_id, time) to amount, so counts land in the right bucket even if the push is late
         self.cache = Counter()
+        self.spill = SpillFile(
+            bot_storage.config.get('spill_directory', 'data/spill'),
+            'messages',
+            max_bytes=bot_storage.config.get('spill_max_bytes', 64 * 1024 * 1024),
+        )
+        for guild_id, channel_id, user_id, time, amount in self.spill.replay():
+            self.cache[(guild_id, channel_id, user_id, datetime.datetime.fromisoformat(time))] += amount
+        # Messages per guild over the last day, keyed by guild_id
+        self.rolling = RollingCounter()
+        self.rolling_ready = False
+        # Held while counts are on their way to the database, when they're in neither the cache nor the tables
+        self.push_lock = asyncio.Lock()
+        self.bot.loop.create_task(self.seed_rolling())
         self.cooldown = storage_cache.ExpiringDict(60)
+        # Whatever was written before the reload isn't known about
+        self.bot.data_changed('Messages')
+        self.flattener = flatten.FlattenScheduler(
+            self.bot.pool,
+            flatten.MessageFlattener(batch_size=bot_storage.config.get('flatten_batch_size', 50)),
+            concurrency=bot_storage.config.get('flatten_concurrency', 4),
+        )
+        self.flatten_loop.start()
 
     def cog_unload(self):
         self.bot.remove_loop('messagepush')
+        self.flatten_loop.cancel()
+        # Whatever hasn't been pushed is picked back up from the spill when the cog loads again
+        self.spill.close()
+
+    async def seed_rolling(self):
+        # Without pushes going on, everything counted is either in the database or still in the cache, never both
+        async with self.push_lock:
+            async with db.MaybeAcquire(pool=self.bot.pool) as con:
+                entries = await con.fetch(RECENT_HOURLY)
+            rolling = RollingCounter()
+            for entry in entries:
+                rolling.add(entry['guild_id'], entry['amount'], time=entry['time'])
+            for (guild_id, _, _, time), amount in self.cache.items():
+                rolling.add(guild_id, amount, time=time)
+            # Messages counted live while seeding are in the cache, so they're already part of it
+            self.rolling = rolling
+            self.rolling_ready = True
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild: discord.Guild):
@@ -58,7 +204,12 @@ class Messages(commands.Cog):
             return
         if not await stat_config.should_log(self.bot, message.guild, message.channel, message.author):
             return
-        self.cache[(message.guild.id, message.channel.id, message.author.id)] += 1
+        key = (message.guild.id, message.channel.id, message.author.id, tutil.floor_time(top=30))
+        if not self.spill.append(*key, 1):
+            # The database has been down long enough for the spill to fill up
+            return
+        self.cache[key] += 1
+        self.rolling.add(message.guild.id)
         cool = await guild_config.get_guild_settings(self.bot, message.guild)
         if cool is None:
             wait = 60
@@ -70,9 +221,29 @@ class Messages(commands.Cog):
     async def update_loop(self, time: datetime.datetime):
         if time.minute % 5 == 0:
             await self.push()
-        if time.minute == 0 and time.hour == 0:
-            print('Updating flattening...')
+
+    @tasks.loop(hours=24)
+    async def flatten_loop(self):
+        logging.info('Updating flattening...')
+        # Anything that isn't caught here would stop the loop until the cog is reloaded
+        try:
             await self.push_flat()
+        except Exception:
+            logging.exception('Flattening failed, trying again tomorrow')
+
+    @flatten_loop.before_loop
+    async def before_flatten(self):
+        await self.bot.wait_until_ready()
+        today = tutil.get_utc().date()
+        # Finish off a run that was stopped part of the way through
+        try:
+            if await self.flattener.has_started(today):
+                await self.push_flat()
+        except Exception:
+            logging.exception('Could not finish the flattening from earlier today')
+        await discord.utils.sleep_until(datetime.datetime.combine(
+            today + datetime.timedelta(days=1), datetime.time(), tzinfo=datetime.timezone.utc,
+        ))
 
     async def push_flat(self):
         g_settings = {}
@@ -86,11 +257,10 @@ class Messages(commands.Cog):
                 'time': e['time_remove'],
                 'detail': e['detail_remove']
             }
-        for g, setting in g_settings.items():
-            async with db.MaybeAcquire(pool=self.bot.pool) as con:
-                await self.flat_specific(g, setting['specific'], con)
-                await self.flat_time(g, setting['time'], con)
-                await self.flat_details(g, setting['detail'], con)
+        report = await self.flattener.run(g_settings, tutil.get_utc().date())
+        if report is None:
+            return
+        self.bot.data_changed('Messages')
         not_in = []
         command = 'INSERT INTO messages(guild_id) VALUES {0} ON CONFLICT ON CONSTRAINT unique_message DO NOTHING;'
         for guild in self.bot.guilds:
@@ -110,149 +280,67 @@ class Messages(commands.Cog):
         await ctx.check(0)
 
     async def push(self):
+        async with self.push_lock:
+            await self._push()
+
+    async def _push(self):
         if len(self.cache) == 0:
             return
-        insert = []
-        time = tutil.floor_time(top=30)
-        time_str = time.strftime("'%Y-%m-%d %H:%M:%S'")
-        interval = "INTERVAL '30 MINUTES'"
-        value = '({0}, {1}, {2}, {3}, {4}, {5})'
-        for data, amount in self.cache.items():
-            insert.append(value.format(str(data[0]), str(data[1]), str(data[2]), amount, time_str, interval))
-
-        command = 'INSERT INTO messages(guild_id, channel_id, user_id, amount, time, interval) VALUES {0} ' \
-                  'ON CONFLICT ON CONSTRAINT unique_message' \
-                  ' DO UPDATE SET amount = messages.amount + EXCLUDED.amount;'
-        command = command.format(', '.join(insert))
+        cache, self.cache = self.cache, Counter()
+        segments = self.spill.rotate()
+        try:
+            async with db.MaybeAcquire(pool=self.bot.pool) as con:
+                await write_messages(con, cache)
+        except Exception:
+            # Keep it for the next push, with only one line per counter on disk
+            self.cache.update(cache)
+            self.spill.compact(segments, [(*key, amount) for key, amount in cache.items()])
+            if self.spill.dropped:
+                logging.warning('Message spill is full, dropped {0} messages'.format(self.spill.dropped))
+            raise
+        self.spill.discard(segments)
+        self.bot.data_changed('Messages')
+
+    @commands.command(name='*flatten', hidden=True)
+    @commands.is_owner()
+    async def flatten_command(self, ctx: Context):
+        """Flattens any guilds that haven't been flattened today."""
+        if self.flattener.running:
+            return await ctx.send(embed=ctx.create_embed('Flattening `{0}/{1}` guilds'.format(
+                self.flattener.completed, self.flattener.total,
+            )))
+        await self.push_flat()
+        report = self.flattener.report
+        await ctx.send(embed=ctx.create_embed('Flattened `{0}` guilds, removed `{1}` rows and added `{2}` rows'.format(
+            self.flattener.completed, report.total_removed(), report.total_added(),
+        )))
+
+    async def flat_pass(self, ctx, guild_id, days, *pass_names):
+        if ctx.bot.get_guild(guild_id) is None:
+            return await ctx.send('Not a guild!')
+        passes = [flat_pass for flat_pass in flatten.PASSES if flat_pass[0] in pass_names]
+        flattener = flatten.MessageFlattener(passes=passes)
+        settings = {guild_id: {'specific': days, 'time': days, 'detail': days}}
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            await con.execute(command)
-        self.cache.clear()
+            report = await flattener.flatten(con, settings)
+        await ctx.send(embed=ctx.create_embed('Removed `{0}` rows and added `{1}` rows in `{2:.3f}s`'.format(
+            report.total_removed(), report.total_added(), report.total_duration(),
+        )))
 
     @commands.command(name='*flatspecific', hidden=True)
     @commands.is_owner()
     async def flat_specific_command(self, ctx: Context, guild_id: int, upper: int):
-        if ctx.bot.get_guild(guild_id) is None:
-            return await ctx.send('Not a guild!')
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            await self.flat_specific(guild_id, upper, con)
-        await ctx.check(0)
+        await self.flat_pass(ctx, guild_id, upper, 'specific', 'daily_specific', 'voice_specific')
 
     @commands.command(name='*flattime', hidden=True)
     @commands.is_owner()
-    async def flat_specific_command(self, ctx: Context, guild_id: int, upper: int):
-        if ctx.bot.get_guild(guild_id) is None:
-            return await ctx.send('Not a guild!')
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            await self.flat_time(guild_id, upper, con)
-        await ctx.check(0)
+    async def flat_time_command(self, ctx: Context, guild_id: int, upper: int):
+        await self.flat_pass(ctx, guild_id, upper, 'time', 'voice_time')
 
     @commands.command(name='*flatdetails', hidden=True)
     @commands.is_owner()
-    async def flat_specific_command(self, ctx: Context, guild_id: int, upper: int):
-        if ctx.bot.get_guild(guild_id) is None:
-            return await ctx.send('Not a guild!')
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            await self.flat_details(guild_id, upper, con)
-        await ctx.check(0)
-
-    async def flat_specific(self, guild_id, days, con):
-        interval = f"INTERVAL '{days} DAYS'"
-        command = f"DELETE FROM messages WHERE time <= NOW() at time zone 'utc' - {interval} AND guild_id = {guild_id} AND channel_id IS NOT NULL AND user_id IS NOT NULL RETURNING *;"
-        entries = await con.fetch(command)
-        channels = Counter()
-        users = Counter()
-        for e in entries:
-            channels[(e['channel_id'], e['time'], e['interval'])] += e['amount']
-            users[(e['user_id'], e['time'], e['interval'])] += e['amount']
-        value = '({0}, {1}, {2}, {3}, {4})'
-        if len(channels) > 0:
-            channel_values = []
-            for channel_id, time, interval in channels.keys():
-                amount = channels[(channel_id, time, interval)]
-                channel_values.append(
-                    value.format(str(guild_id), str(channel_id), str(amount), f"TIMESTAMP '{time}'", f"INTERVAL '{interval}'"))
-
-            channel_command = 'INSERT INTO messages(guild_id, channel_id, amount, time, interval) VALUES {0} ' \
-                              'ON CONFLICT ON CONSTRAINT unique_message' \
-                              ' DO UPDATE SET amount = messages.amount + EXCLUDED.amount;'
-            channel_command = channel_command.format(', '.join(channel_values))
-            await con.execute(channel_command)
-
-        if len(users) > 0:
-            user_values = []
-            for user_id, time, interval in users.keys():
-                amount = users[(user_id, time, interval)]
-                user_values.append(
-                    value.format(str(guild_id), str(user_id), str(amount), f"TIMESTAMP '{time}'",
-                                 f"INTERVAL '{interval}'"))
-
-            user_command = 'INSERT INTO messages(guild_id, user_id, amount, time, interval) VALUES {0} ' \
-                           'ON CONFLICT ON CONSTRAINT unique_message' \
-                           ' DO UPDATE SET amount = messages.amount + EXCLUDED.amount;'
-            user_command = user_command.format(', '.join(user_values))
-            await con.execute(user_command)
-
-    async def flat_time(self, guild_id, days, con):
-        interval = f"INTERVAL '{days} DAYS'"
-        command = f"DELETE FROM messages WHERE time <= NOW() at time zone 'utc' - {interval} AND guild_id = {guild_id} AND (channel_id IS NOT NULL or user_id IS NOT NULL) RETURNING *;"
-        entries = await con.fetch(command)
-        channels = Counter()
-        users = Counter()
-        for e in entries:
-            if e['channel_id'] is not None:
-                channels[(e['channel_id'], e['time'].date(), e['interval'])] += e['amount']
-            if e['user_id'] is not None:
-                users[(e['user_id'], e['time'].date(), e['interval'])] += e['amount']
-        value = '({0}, {1}, {2}, {3}, {4})'
-        if len(channels) > 0:
-            channel_values = []
-            for channel_id, time, interval in channels.keys():
-                amount = channels[(channel_id, time, interval)]
-                channel_values.append(
-                    value.format(str(guild_id), str(channel_id), str(amount), f"TIMESTAMP '{datetime.datetime.combine(time, datetime.datetime.min.time())}'",
-                                 "INTERVAL '1 DAY'"))
-
-            channel_command = 'INSERT INTO messages(guild_id, channel_id, amount, time, interval) VALUES {0} ' \
-                              'ON CONFLICT ON CONSTRAINT unique_message' \
-                              ' DO UPDATE SET amount = messages.amount + EXCLUDED.amount;'
-            channel_command = channel_command.format(', '.join(channel_values))
-            await con.execute(channel_command)
-
-        if len(users) > 0:
-            user_values = []
-            for user_id, time, interval in users.keys():
-                amount = users[(user_id, time, interval)]
-                user_values.append(
-                    value.format(str(guild_id), str(user_id), str(amount), f"TIMESTAMP '{datetime.datetime.combine(time, datetime.datetime.min.time())}'",
-                                 "INTERVAL '1 DAY'"))
-
-            user_command = 'INSERT INTO messages(guild_id, user_id, amount, time, interval) VALUES {0} ' \
-                           'ON CONFLICT ON CONSTRAINT unique_message' \
-                           ' DO UPDATE SET amount = messages.amount + EXCLUDED.amount;'
-            user_command = user_command.format(', '.join(user_values))
-            await con.execute(user_command)
-
-    async def flat_details(self, guild_id, days, con):
-        interval = f"INTERVAL '{days} DAYS'"
-        command = f"DELETE FROM messages WHERE time <= NOW() at time zone 'utc' - {interval} AND guild_id = {guild_id} RETURNING *;"
-        entries = await con.fetch(command)
-        channels = Counter()
-        for e in entries:
-            if e['channel_id'] is not None:
-                channels[(e['time'], e['interval'])] += e['amount']
-        if len(channels) > 0:
-            value = '({0}, {1}, {2}, {3})'
-            channel_values = []
-            for time, interval in channels.keys():
-                amount = channels[(time, interval)]
-                channel_values.append(
-                    value.format(str(guild_id), str(amount), f"TIMESTAMP '{time}'", f"INTERVAL '{interval}'"))
-
-            channel_command = 'INSERT INTO messages(guild_id, amount, time, interval) VALUES {0} ' \
-                              'ON CONFLICT ON CONSTRAINT unique_message' \
-                              ' DO UPDATE SET amount = messages.amount + EXCLUDED.amount;'
-            channel_command = channel_command.format(', '.join(channel_values))
-            await con.execute(channel_command)
+    async def flat_details_command(self, ctx: Context, guild_id: int, upper: int):
+        await self.flat_pass(ctx, guild_id, upper, 'detail', 'daily_detail', 'voice_detail')
 
 
 def setup(bot):
@@ -0,0 +1,306 @@
+"""
+Aggregated queries for statistics.
+
+Everything is grouped inside of PostgreSQL so that only the small result sets that the embeds and graphs
+need are sent back over the wire.
+"""
+from datetime import timedelta
+
+import numpy as np
+
+from bot.util import time_util as tutil
+
+# Rows that have a channel hold full or channel level detail. Rows with both channel and user missing are from
+# a fully flattened guild. Together these make up the real message count.
+COUNTED = '(channel_id IS NOT NULL OR user_id IS NULL)'
+# Used for the daily graph where we care about rows that still have user information.
+USER_COUNTED = '(user_id IS NOT NULL OR channel_id IS NULL)'
+SMALL_LOSS = '(channel_id IS NULL AND user_id IS NOT NULL)'
+BIG_LOSS = '(channel_id IS NULL AND user_id IS NULL)'
+
+
+def voice_since(start):
+    """
+    Voice rows whose bucket ends after `start`.
+
+    Flattened rows hold the summed time of many sessions, so `time + amount` can reach far past the bucket the row
+    stands for. The bucket's own length is used instead.
+    """
+    return 'voice.time + voice.interval > {0}'.format(start)
+
+
+def where(*conditions):
+    return ' AND '.join(condition for condition in conditions if condition)
+
+
+class Rollup:
+    """
+    A table that message data can be read from.
+
+    Non detailed rollups only store what would be counted for a guild, so they have no channel or user columns.
+    """
+
+    def __init__(self, table, granularity: timedelta, *, detailed=True):
+        self.table = table
+        self.granularity = granularity
+        self.detailed = detailed
+
+    def filter(self, condition):
+        # Non detailed rollups only hold rows that would've already passed any of the filters
+        if self.detailed:
+            return condition
+        return None
+
+
+RAW = Rollup('messages', timedelta(minutes=30))
+HOURLY = Rollup('messages_hourly', timedelta(hours=1), detailed=False)
+DAILY = Rollup('messages_daily', timedelta(days=1))
+
+# Coarsest first
+ROLLUPS = (DAILY, HOURLY, RAW)
+
+# The amount of buckets an interval has to cover before a rollup is used. The bucket that the start of the
+# interval lands in gets dropped, so this keeps the error small.
+MINIMUM_BUCKETS = 24
+
+
+def choose_rollup(interval: timedelta, *, detailed=True, resolution: timedelta = None):
+    """
+    Gets the coarsest rollup that can answer a query over the interval.
+
+    :param detailed: Whether the query needs channel or user information
+    :param resolution: The largest granularity the query can use
+    """
+    for rollup in ROLLUPS:
+        if detailed and not rollup.detailed:
+            continue
+        if resolution is not None and rollup.granularity > resolution:
+            continue
+        if rollup.granularity * MINIMUM_BUCKETS > interval:
+            continue
+        return rollup
+    return RAW
+
+
+class MessageSummary:
+    """
+    Aggregated message information for a selection over a period of time.
+    """
+
+    top_amount = 10
+
+    def __init__(self, condition, interval: timedelta, *, detailed=True):
+        self.condition = condition
+        self.interval = interval
+        # If the condition uses anything other than guild_id
+        self.detailed = detailed
+        self.entries = 0
+        self.total = 0
+        self.small = 0
+        self.big = 0
+        self.first = None
+        self.last = None
+        self.users = []
+        self.users_total = 0
+        self.channels = []
+        self.channels_total = 0
+        self.guilds = []
+        self.guilds_total = 0
+        # Amount for every hour of the day
+        self.hours = np.zeros(24, dtype=np.int64)
+        # Days, seconds into the day, and amounts
+        self.week = (np.array([], dtype='datetime64[D]'), np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+        # Days and amounts
+        self.daily = (np.array([], dtype='datetime64[D]'), np.array([], dtype=np.int64))
+
+    @property
+    def time_condition(self):
+        return "time >= NOW() at time zone 'utc' - INTERVAL '{0} SECONDS'".format(self.interval.total_seconds())
+
+    def is_empty(self):
+        return self.entries == 0
+
+    def spans_days(self):
+        # Same bounds that the old python implementation started out with
+        now = tutil.get_utc()
+        first = min(now, self.first or now)
+        last = max(now - timedelta(hours=1), self.last or now)
+        return (last - first).days > 0
+
+    async def fetch(self, connection, *, users=True, channels=True, guilds=False):
+        await self.fetch_grouped(connection)
+        if self.is_empty():
+            return self
+        if not users:
+            self.users, self.users_total = [], 0
+        if not channels:
+            self.channels, self.channels_total = [], 0
+        if guilds:
+            self.guilds, self.guilds_total = await self.fetch_top(connection, 'guild_id')
+        await self.fetch_hours(connection)
+        await self.fetch_week(connection)
+        return self
+
+    # GROUPING() bits for (user_id, channel_id, day), a 1 means the column isn't grouped on
+    GROUPED_ALL = 0b111
+    GROUPED_USER = 0b011
+    GROUPED_CHANNEL = 0b101
+    GROUPED_DAY = 0b110
+
+    async def fetch_grouped(self, connection):
+        """
+        Gets the totals, top users, top channels, and daily amounts with one pass over the table.
+        """
+        command = (
+            'SELECT * FROM ('
+            'SELECT *, (SUM(amount) OVER (PARTITION BY grouping))::bigint AS grouping_total, '
+            'ROW_NUMBER() OVER (PARTITION BY grouping ORDER BY amount DESC) AS rank FROM ('
+            'SELECT GROUPING(user_id, channel_id, time::date) AS grouping, user_id, channel_id, time::date AS day, '
+            'COUNT(*) AS entries, SUM(amount) AS amount, '
+            'COALESCE(SUM(amount) FILTER (WHERE {1}), 0) AS total, '
+            'COALESCE(SUM(amount) FILTER (WHERE {2}), 0) AS small, '
+            'COALESCE(SUM(amount) FILTER (WHERE {3}), 0) AS big, '
+            'COALESCE(SUM(amount) FILTER (WHERE {4}), 0) AS user_total, '
+            'MIN(time) FILTER (WHERE channel_id IS NOT NULL) AS first, '
+            'MAX(time) FILTER (WHERE channel_id IS NOT NULL) AS last '
+            'FROM {5} WHERE {0} GROUP BY GROUPING SETS ((), (user_id), (channel_id), (time::date))'
+            ') grouped WHERE NOT (grouping = {6} AND user_id IS NULL) AND NOT (grouping = {7} AND channel_id IS NULL)'
+            ') ranked WHERE grouping NOT IN ({6}, {7}) OR rank <= {8};'
+        )
+        rollup = choose_rollup(self.interval, resolution=timedelta(days=1))
+        command = command.format(
+            where(self.condition, self.time_condition),
+            COUNTED,
+            SMALL_LOSS,
+            BIG_LOSS,
+            USER_COUNTED,
+            rollup.table,
+            self.GROUPED_USER,
+            self.GROUPED_CHANNEL,
+            self.top_amount,
+        )
+        entries = await connection.fetch(command)
+        users = []
+        channels = []
+        days = []
+        for entry in entries:
+            grouping = entry['grouping']
+            if grouping == self.GROUPED_ALL:
+                self.entries = entry['entries']
+                self.total = entry['total']
+                self.small = entry['small']
+                self.big = entry['big']
+                self.first = entry['first']
+                self.last = entry['last']
+            elif grouping == self.GROUPED_USER:
+                users.append((entry['rank'], entry['user_id'], entry['amount']))
+                self.users_total = entry['grouping_total']
+            elif grouping == self.GROUPED_CHANNEL:
+                channels.append((entry['rank'], entry['channel_id'], entry['amount']))
+                self.channels_total = entry['grouping_total']
+            elif grouping == self.GROUPED_DAY and entry['user_total']:
+                days.append((entry['day'], entry['user_total']))
+        self.users = [(user_id, amount) for _, user_id, amount in sorted(users)]
+        self.channels = [(channel_id, amount) for _, channel_id, amount in sorted(channels)]
+        if days:
+            day, amount = zip(*days)
+            self.daily = (np.array(day, dtype='datetime64[D]'), np.array(amount, dtype=np.int64))
+
+    async def fetch_top(self, connection, key):
+        """Gets the top rows for a key along with the total of every row that has the key."""
+        command = (
+            'SELECT {1} AS id, SUM(amount) AS amount, (SUM(SUM(amount)) OVER ())::bigint AS total '
+            'FROM {3} WHERE {0} GROUP BY {1} ORDER BY amount DESC LIMIT {2};'
+        )
+        # Guilds can be grouped without any of the detail
+        rollup = choose_rollup(self.interval, detailed=self.detailed or key != 'guild_id')
+        command = command.format(
+            where(self.condition, '{0} IS NOT NULL'.format(key), self.time_condition),
+            key,
+            self.top_amount,
+            rollup.table,
+        )
+        entries = await connection.fetch(command)
+        if not entries:
+            return [], 0
+        return [(e['id'], e['amount']) for e in entries], entries[0]['total']
+
+    async def fetch_hours(self, connection):
+        command = (
+            'SELECT EXTRACT(HOUR FROM time)::int AS hour, SUM(amount) AS amount '
+            'FROM {1} WHERE {0} GROUP BY hour;'
+        )
+        rollup = choose_rollup(self.interval, detailed=self.detailed, resolution=timedelta(hours=1))
+        command = command.format(
+            where(self.condition, rollup.filter(COUNTED), self.time_condition),
+            rollup.table,
+        )
+        entries = await connection.fetch(command)
+        for entry in entries:
+            self.hours[entry['hour']] = entry['amount']
+
+    async def fetch_week(self, connection):
+        command = (
+            "SELECT time::date AS day, EXTRACT(EPOCH FROM time::time)::int AS seconds, SUM(amount) AS amount "
+            "FROM {1} WHERE {0} AND time >= (NOW() at time zone 'utc')::date - INTERVAL '7 DAYS' "
+            "GROUP BY day, seconds;"
+        )
+        rollup = choose_rollup(
+            min(self.interval, timedelta(days=8)),
+            detailed=self.detailed,
+            resolution=timedelta(hours=1),
+        )
+        command = command.format(
+            where(self.condition, rollup.filter(COUNTED), self.time_condition),
+            rollup.table,
+        )
+        entries = await connection.fetch(command)
+        if entries:
+            days, seconds, amounts = zip(*((e['day'], e['seconds'], e['amount']) for e in entries))
+            self.week = (
+                np.array(days, dtype='datetime64[D]'),
+                np.array(seconds, dtype=np.int64),
+                np.array(amounts, dtype=np.int64),
+            )
+
+
+class VoiceSummary:
+    """
+    Voice rows for a selection, loaded once into columns that the embed and graph both read from.
+
+    Missing channels and users are stored as 0.
+    """
+
+    def __init__(self, entries):
+        self.times = np.array([e['time'] for e in entries], dtype='datetime64[s]')
+        self.seconds = np.array([e['amount'].total_seconds() for e in entries], dtype=np.float64)
+        self.channels = np.array([e['channel_id'] or 0 for e in entries], dtype=np.int64)
+        self.users = np.array([e['user_id'] or 0 for e in entries], dtype=np.int64)
+
+    @classmethod
+    async def fetch(cls, connection, condition, interval):
+        command = "SELECT time, amount, channel_id, user_id FROM voice WHERE {0};"
+        command = command.format(where(
+            condition,
+            voice_since("NOW() at time zone 'utc' - INTERVAL '{0}'".format(interval)),
+        ))
+        return cls(await connection.fetch(command))
+
+    def total(self):
+        # Rows flattened down to only a user are already counted in the channel rows
+        counted = (self.channels != 0) | (self.users == 0)
+        return self.seconds[counted].sum()
+
+    def top(self, key, *, n=10):
+        """Gets the IDs with the most time for `user_id` or `channel_id`."""
+        ids = self.users if key == 'user_id' else self.channels
+        found = ids != 0
+        unique, inverse = np.unique(ids[found], return_inverse=True)
+        totals = np.bincount(inverse, weights=self.seconds[found], minlength=len(unique))
+        order = np.argsort(totals)[::-1][:n]
+        return [(int(unique[index]), totals[index]) for index in order]
+
+    def occupancy(self):
+        """Columns for the voice graph, which only needs rows that still have a user."""
+        found = self.users != 0
+        return self.times[found], self.seconds[found], self.users[found]
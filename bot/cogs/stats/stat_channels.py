@@ -8,20 +8,20 @@ from enum import Enum
 from bot.cogs.stats.channels import *
 from glocklib import context as Context
 from glocklib.paginator import Prompt
+import bot as bot_storage
+from bot.util import renames
+from bot.util import statements
 
 
 class ChannelTypes(Enum):
     members = 0
     messages = 1
     voice = 2
+    top_channel = 3
 
     @classmethod
     def to_class(cls, number):
-        if number == ChannelTypes.messages:
-            return MessageStatChannel()
-        if number == ChannelTypes.voice:
-            return VoiceStatChannel()
-        return None
+        return TYPES.get(number.value)
 
 
 class StatChannelsTable(db.Table, table_name='stat_channels'):
@@ -41,11 +41,32 @@ class StatChannelsTable(db.Table, table_name='stat_channels'):
         return statement + '\n' + sql
 
 
+ALL_CHANNELS = statements.register('stat_channels', 'SELECT * FROM stat_channels;')
+GUILD_CHANNELS = statements.register('stat_channels_guild', 'SELECT * FROM stat_channels WHERE guild_id = $1;')
+GET_CHANNEL = statements.register(
+    'stat_channel',
+    'SELECT * FROM stat_channels WHERE guild_id = $1 AND id = $2;',
+)
+DELETE_CHANNEL = statements.register(
+    'stat_channel_delete',
+    'DELETE FROM stat_channels WHERE guild_id = $1 AND id = $2;',
+)
+COUNT_CHANNELS = statements.register(
+    'stat_channel_count',
+    'SELECT COUNT(id) AS count, COUNT(id) FILTER (WHERE channel_id = $2) AS already '
+    'FROM stat_channels WHERE guild_id = $1;',
+)
+
+
 class StatChannels(commands.Cog):
     """Modifying and interacting with stat channels."""
 
     def __init__(self, bot):
         self.bot = bot
+        self.renamer = renames.RenameScheduler(
+            workers=bot_storage.config.get('rename_workers', 4),
+            global_rate=bot_storage.config.get('rename_rate', 1),
+        )
         self.bot.add_loop('statchannels', self.channel_loop)
 
     def cog_unload(self):
@@ -55,33 +76,47 @@ class StatChannels(commands.Cog):
     @commands.is_owner()
     async def refresh(self, ctx):
         """Forces a refresh of the statistic channels"""
-        await self.refresh_channels()
-        await ctx.check(0)
+        report = await self.refresh_channels()
+        if report is None:
+            return await ctx.send(embed=ctx.create_embed('Channels are still being renamed from the last refresh!', error=True))
+        await ctx.send(embed=ctx.create_embed('Refreshed, `{0}` renames queued\n{1}'.format(
+            report.total - report.skipped - report.deferred, report,
+        )))
+        # Renames are spread out over a while, so say when they're done separately
+        self.bot.loop.create_task(self.send_rename_report(ctx, report))
+
+    async def send_rename_report(self, ctx, report):
+        await self.renamer.wait()
+        await ctx.send(embed=ctx.create_embed('Renames finished\n{0}'.format(report)))
 
     async def channel_loop(self, time):
         if time.minute % 30 == 0:
             await self.refresh_channels()
 
     async def refresh_channels(self):
-        to_edit = []
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            command = "SELECT * FROM stat_channels;"
-            entries = await con.fetch(command)
+            entries = await ALL_CHANNELS.fetch(con)
+            by_type = {}
             for entry in entries:
-                guild_id = entry['guild_id']
-                channel_id = entry['channel_id']
-                channel_type = entry['type']
-                name = entry['name']
-                arguments = entry['arguments']
+                if self.bot.get_guild(entry['guild_id']) is None:
+                    continue
+                by_type.setdefault(entry['type'], []).append(entry)
+
+            to_edit = []
+            # Every channel of a type and window shares one grouped query, no matter how many guilds use it
+            for channel_type, type_entries in by_type.items():
                 try:
-                    converter = ChannelTypes.to_class(
-                        ChannelTypes(channel_type),
-                    )
-                except KeyError:
+                    converter = ChannelTypes.to_class(ChannelTypes(channel_type))
+                except ValueError:
+                    continue
+                if converter is None:
                     continue
-                channel_name = await converter.name_from_sql(guild_id, channel_id, name, arguments, con)
-                to_edit.append((guild_id, channel_id, channel_name))
+                values = await converter.values(self.bot, type_entries, con)
+                for entry in type_entries:
+                    channel_name = entry['name'].replace('{0}', values[(entry['guild_id'], entry['arguments'])])
+                    to_edit.append((entry['guild_id'], entry['channel_id'], channel_name))
 
+        renames = []
         for guild_id, channel_id, new_name in to_edit:
             guild = self.bot.get_guild(guild_id)
             if guild is None:
@@ -89,7 +124,9 @@ class StatChannels(commands.Cog):
             channel = guild.get_channel(channel_id)
             if channel is None:
                 continue
-            await channel.edit(name=new_name)
+            renames.append((channel, new_name))
+        # Renames happen in the background so they don't hold up the rest of the time loop
+        return self.renamer.start(renames)
 
     @commands.group(name='!channels', aliases=['!channel'])
     @checks.is_manager_or_perms()
@@ -105,15 +142,14 @@ class StatChannels(commands.Cog):
         """
         List's the current stat channels for the server.
         """
-        command = 'SELECT * FROM stat_channels WHERE guild_id = {0};'
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            entries = await con.fetch(command.format(ctx.guild.id))
+            entries = await GUILD_CHANNELS.fetch(con, ctx.guild.id)
         message = []
         for e in entries:
             channel_type = e['type']
             try:
                 converter = ChannelTypes.to_class(ChannelTypes(channel_type))
-            except KeyError:
+            except ValueError:
                 message.append('Error on {0}'.format(e['guild_id']))
                 continue
             message.append('{1} (id {0})'.format(
@@ -134,9 +170,8 @@ class StatChannels(commands.Cog):
             delete 581
             delete 763
         """
-        command = 'SELECT * FROM stat_channels WHERE guild_id = {0} AND id = {1};'
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            entry = await con.fetchrow(command.format(ctx.guild.id, id))
+            entry = await GET_CHANNEL.fetchrow(con, ctx.guild.id, id)
         if entry is None:
             return await ctx.send(embed=ctx.create_embed("That channel doesn't exist!", error=True))
         page = Prompt('Are you sure you want to stat channel <#{0}>?\n\n*This will not delete the channel'.format(entry['channel_id']))
@@ -144,9 +179,8 @@ class StatChannels(commands.Cog):
         result = page.result
         if not result:
             return await ctx.send(embed=ctx.create_embed('Cancelled!'))
-        command = 'DELETE FROM stat_channels WHERE guild_id = {0} AND id = {1};'
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            await con.execute(command.format(ctx.guild.id, id))
+            await DELETE_CHANNEL.execute(con, ctx.guild.id, id)
         await ctx.send(embed=ctx.create_embed('Deleted!'))
 
     @channels.command(name="create")
@@ -164,12 +198,9 @@ class StatChannels(commands.Cog):
         """
         if channel is None:
             return await ctx.send(embed=ctx.create_embed('You have to specify a channel to convert!', error=True))
-        count_command = 'SELECT COUNT(id) FROM stat_channels WHERE guild_id = {0};'.format(ctx.guild.id)
-        already_command = 'SELECT COUNT(id) FROM stat_channels WHERE guild_id = {0} AND channel_id = {1};'
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            already = await con.fetchrow(already_command.format(ctx.guild.id, channel.id))
-            entry = await con.fetchrow(count_command)
-        if already['count'] != 0:
+            entry = await COUNT_CHANNELS.fetchrow(con, ctx.guild.id, channel.id)
+        if entry['already'] != 0:
             return await ctx.send(embed=ctx.create_embed("You can't have multiple stat channels on one channel!", error=True))
         if entry['count'] > 7:
             return await ctx.send(embed=ctx.create_embed("You have too many stat channels set up!", error=True))
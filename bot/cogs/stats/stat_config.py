@@ -1,9 +1,10 @@
 import discord
 import typing
 from discord.ext import commands
+from lru import LRU
 from glocklib import database as db, checks
 from glocklib import paginator
-from bot.util import storage_cache as cache
+from bot.util import statements
 from glocklib import context as Context
 from bot.util.formats import human_bool
 from bot.util.selection import FilterType
@@ -24,6 +25,16 @@ class StatConfig(db.Table, table_name='stat_config'):
         return statement + '\n' + sql
 
 
+GET_STAT_CONFIG = statements.register(
+    'stat_config',
+    'SELECT type, object_id, allow FROM stat_config WHERE guild_id = $1;',
+)
+
+
+# Results kept per guild for (channel, category, role set)
+RESULT_CACHE_SIZE = 512
+
+
 class StatPermissions:
 
     def __init__(self, guild_id, db_rows):
@@ -51,29 +62,63 @@ class StatPermissions:
                 self.users[object_id] = allow
             elif stat_type == FilterType.role:
                 self.roles[object_id] = allow
+        # Compiled lazily since channels and roles are only known once they're seen
+        self._bases = {}
+        self._results = LRU(RESULT_CACHE_SIZE)
+
+    def clear(self):
+        """Forgets every compiled result. Needed when something that isn't part of the key changes, like role order."""
+        self._bases.clear()
+        self._results.clear()
+
+    def channel_base(self, channel):
+        """Whether a channel is allowed before any roles or users are looked at."""
+        key = (channel.id, channel.category_id)
+        allowed = self._bases.get(key)
+        if allowed is None:
+            allowed = self.channels.get(channel.id)
+            if allowed is None:
+                allowed = self.categories.get(channel.category_id, self.guild)
+            self._bases[key] = allowed
+        return allowed
 
-    def is_allowed(self, channel, user: discord.Member):
-        allowed = self.guild
-
-        category = channel.category
-        if category:
-            category_allowed = self.categories.get(category.id)
-            if category_allowed is not None:
-                allowed = category_allowed
-
-        channel_allowed = self.channels.get(channel.id)
-        if channel_allowed is not None:
-            allowed = channel_allowed
-
+    def role_override(self, user):
+        # Roles are sorted lowest to highest, so the highest configured role wins
+        allowed = None
         for role in user.roles:
             role_allowed = self.roles.get(role.id)
             if role_allowed is not None:
                 allowed = role_allowed
+        return allowed
+
+    @staticmethod
+    def role_ids(user):
+        return tuple(sorted(role.id for role in getattr(user, 'roles', ())))
 
+    def forget(self, user):
+        """Drops every result compiled for a member's role set."""
+        role_ids = self.role_ids(user)
+        for key in [key for key in self._results.keys() if key[2] == role_ids]:
+            del self._results[key]
+
+    def is_allowed(self, channel, user: discord.Member):
         user_allowed = self.users.get(user.id)
         if user_allowed is not None:
-            allowed = user_allowed
-
+            return user_allowed
+        if not self.roles:
+            return self.channel_base(channel)
+        role_ids = self.role_ids(user)
+        if not role_ids:
+            # Not a member, so there aren't any roles to look at
+            return self.channel_base(channel)
+
+        key = (channel.id, channel.category_id, role_ids)
+        allowed = self._results.get(key)
+        if allowed is None:
+            allowed = self.role_override(user)
+            if allowed is None:
+                allowed = self.channel_base(channel)
+            self._results[key] = allowed
         return allowed
 
 
@@ -89,19 +134,51 @@ class StatisticConfig(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        # Compiled permissions for every guild that has been seen. Only this cog changes stat_config.
+        self.permissions = {}
 
-    @cache.cache()
     async def get_stat_config(self, guild_id):
-        command = 'SELECT type, object_id, allow FROM stat_config WHERE guild_id = {0};'
-        command = command.format(guild_id)
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            entries = await con.fetch(command)
-        return StatPermissions(guild_id, entries)
+        perms = self.permissions.get(guild_id)
+        if perms is None:
+            async with db.MaybeAcquire(pool=self.bot.pool) as con:
+                entries = await GET_STAT_CONFIG.fetch(con, guild_id)
+            perms = StatPermissions(guild_id, entries)
+            self.permissions[guild_id] = perms
+        return perms
+
+    def invalidate(self, guild_id):
+        self.permissions.pop(guild_id, None)
 
     async def is_allowed(self, guild, channel, user):
         perms = await self.get_stat_config(guild.id)
         return perms.is_allowed(channel, user)
 
+    def _clear_results(self, guild_id):
+        perms = self.permissions.get(guild_id)
+        if perms is not None:
+            perms.clear()
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        if before.position != after.position:
+            self._clear_results(after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.roles == after.roles:
+            return
+        perms = self.permissions.get(after.guild.id)
+        if perms is not None:
+            perms.forget(before)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        self._clear_results(role.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        self.invalidate(guild.id)
+
     @commands.group('!statconfig', aliases=['!sconfig', '!statc'])
     @checks.is_manager()
     @commands.guild_only()
@@ -220,14 +297,14 @@ class StatisticConfig(commands.Cog):
         command = command.format(guild_id, config_type.value, object_id, allow)
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
             await con.execute(command)
-        self.get_stat_config.invalidate(self, guild_id)
+        self.invalidate(guild_id)
 
     async def remove_config(self, guild_id, object_id):
         command = 'DELETE FROM stat_config WHERE guild_id = {0} AND object_id = {1};'
         command = command.format(guild_id, object_id)
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
             await con.execute(command)
-        self.get_stat_config.invalidate(self, guild_id)
+        self.invalidate(guild_id)
 
     @stat_config.command(name='cooldown')
     async def cooldown(self, ctx: Context, seconds: int = None):
@@ -264,9 +341,6 @@ class StatisticConfig(commands.Cog):
         command = command.format(ctx.guild.id, seconds)
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
             await con.execute(command)
-        g_config = self.bot.get_cog('GuildConfig')
-        if g_config:
-            g_config.get_settings.invalidate(g_config, ctx.guild.id)
         await ctx.send(embed=ctx.create_embed('Message cooldown set to `{0}` seconds.'.format(seconds)))
 
     @stat_config.command(name='reset')
@@ -285,7 +359,7 @@ class StatisticConfig(commands.Cog):
         command = command.format(ctx.guild.id)
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
             await con.execute(command)
-        self.get_stat_config.invalidate(self, ctx.guild.id)
+        self.invalidate(ctx.guild.id)
         await ctx.send(embed=ctx.create_embed('Reset command config!'))
 
 
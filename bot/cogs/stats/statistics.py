@@ -1,17 +1,22 @@
+import io
 import re
 import typing
 from collections import Counter
 from datetime import datetime, timedelta
+from functools import partial
 
 from glocklib import database as db
 from bot.util import time_converter
 from bot.util import time_util as tutil
 from bot.util import graphs
+from bot.util import storage_cache
+from bot.cogs.stats import queries
 import discord
 
 from glocklib import context as Context
 from bot.util.paginator import ImagePaginator
 from discord.ext import commands
+from lru import LRU
 
 
 class StatisticType:
@@ -94,6 +99,19 @@ class Statistics(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.main_color = discord.Colour(0x9d0df0)
+        self.summaries = LRU(64)
+
+    def watermark(self, cog_name):
+        """Gets a number that changes every time a cog writes data."""
+        return self.bot.data_versions[cog_name]
+
+    async def render_cached(self, key, function, *args, **kwargs):
+        cache = self.bot.graph_cache
+        image = cache.get(key, storage_cache.MISSING)
+        if image is storage_cache.MISSING:
+            image = await self.bot.renderer.render(function, *args, **kwargs)
+            cache.set(key, image)
+        return image
 
     @commands.group(name='stats', aliases=['statistics', 'stat'])
     @commands.guild_only()
@@ -142,47 +160,54 @@ class Statistics(commands.Cog):
         if interval is None:
             interval = '1 day'
 
-        command = "SELECT * FROM messages WHERE {0} time >= NOW() at time zone 'utc' - INTERVAL {1};"
-        cond = ''
-        if selection.get_condition() is not None:
-            cond = selection.get_condition() + ' AND'
-        command = command.format(cond, "'{0} SECONDS'".format(interval.total_seconds()))
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            entries = await con.fetch(command)
-        if len(entries) == 0:
+        # Data only changes when messages get pushed, so anything in between can be reused
+        key = (selection.get_condition(), round(interval.total_seconds() / 60), self.watermark('Messages'))
+        summary = self.summaries.get(key)
+        if summary is None:
+            summary = queries.MessageSummary(
+                selection.get_condition(),
+                interval,
+                detailed=selection.is_member() or selection.is_channel(),
+            )
+            async with db.MaybeAcquire(pool=self.bot.pool) as con:
+                await summary.fetch(
+                    con,
+                    users=not selection.is_member() and not selection.is_global(),
+                    channels=not selection.is_channel() and not selection.is_global(),
+                    guilds=selection.is_global(),
+                )
+            self.summaries[key] = summary
+        if summary.is_empty():
             return await ctx.send(embed=ctx.create_embed(
                 "Looks like there's no entries for the past {0}! You may have to wait 5-15 minutes for the database to update.".format(interval),
                 error=True
             ))
-        embed = await self.get_message_embed(ctx, selection, entries=entries, interval=interval)
-        images = [graphs.plot_24_hour_messages(entries=entries)]
-        week = graphs.plot_week_messages(entries=entries)
-        past = graphs.plot_daily_message(entries=entries)
-        if week is not None:
-            images.append(week)
-        if past is not None:
-            images.append(past)
+        embed = await self.get_message_embed(ctx, selection, summary, interval=interval)
+        # Pages are only rendered once they're shown
+        pages = [
+            partial(self.render_cached, key + ('24_hour',), graphs.plot_24_hour_messages, summary.hours, days=summary.spans_days()),
+        ]
+        if graphs.week_span(summary.week) >= 2:
+            pages.append(partial(self.render_cached, key + ('week',), graphs.plot_week_messages, summary.week))
+        if graphs.daily_span(summary.daily) >= 3:
+            pages.append(partial(self.render_cached, key + ('daily',), graphs.plot_daily_message, summary.daily))
         if not selection.is_channel() and not selection.is_global():
-            images.append(graphs.plot_message_channel_bar(ctx, entries))
+            values, other = self.bar_values(summary.channels, summary.channels_total, ctx.guild.get_channel)
+            pages.append(partial(self.render_cached, key + ('channel_bar',), graphs.plot_bar, values, other=other))
         if not selection.is_member() and not selection.is_global():
-            images.append(graphs.plot_message_user_bar(ctx, entries))
+            values, other = self.bar_values(summary.users, summary.users_total, ctx.guild.get_member)
+            pages.append(partial(self.render_cached, key + ('user_bar',), graphs.plot_bar, values, other=other))
         embed.set_image(url='attachment://graph.png')
-        menu = ImagePaginator(embed, images)
+        menu = ImagePaginator(embed, pages)
         await menu.start(ctx)
 
-    async def get_message_embed(self, ctx, selection, *, interval='24 Hours', entries=None):
-        if entries is None:
-            command = "SELECT * FROM messages WHERE {0} AND time >= NOW() at time zone 'utc' - INTERVAL '{1}';"
-            command = command.format(selection.get_condition(), interval)
-            async with db.MaybeAcquire(pool=self.bot.pool) as con:
-                entries = await con.fetch(command)
+    async def get_message_embed(self, ctx, selection, summary, *, interval='24 Hours'):
         await ctx.trigger_typing()
-        small, big = self.count_compressed(entries)
-        description = f'Total of `{self.count_all(entries)} messages`\n\n\\*{small} messages lost some data, {big} messages lost most data.\n\n'
+        description = f'Total of `{summary.total} messages`\n\n\\*{summary.small} messages lost some data, {summary.big} messages lost most data.\n\n'
         if not selection.is_member() and not selection.is_global():
             formatted_people = []
             i = 0
-            for p, amount in self.count(entries, 'user_id', n=5):
+            for p, amount in summary.users[:5]:
                 i += 1
                 formatted_people.append(f'`{i}.` <@{p}> - `{amount} messages`')
             description += '**Messages | Top 5 Users**\n' + '\n'.join(formatted_people)
@@ -190,7 +215,7 @@ class Statistics(commands.Cog):
         if not selection.is_channel() and not selection.is_global():
             formatted_channels = []
             i = 0
-            for c, amount in self.count(entries, 'channel_id', n=5):
+            for c, amount in summary.channels[:5]:
                 i += 1
                 formatted_channels.append(f'`{i}.` <#{c}> - `{amount} messages`')
             description += '\n\n **Messages | Top 5 Channels**\n' \
@@ -199,7 +224,7 @@ class Statistics(commands.Cog):
         if selection.is_global() and await self.bot.is_owner(ctx.author):
             formatted_channels = []
             i = 0
-            for c, amount in self.count(entries, 'guild_id', n=5):
+            for c, amount in summary.guilds[:5]:
                 i += 1
                 guild = self.bot.get_guild(c)
                 if guild:
@@ -237,27 +262,23 @@ class Statistics(commands.Cog):
             selection = StatisticType(guild=ctx.guild)
         if interval is None:
             interval = '1 day'
-        command = "SELECT * FROM voice WHERE {0} AND time + amount >= NOW() at time zone 'utc' - INTERVAL '{1}';"
-        command = command.format(selection.get_condition(), interval)
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            entries = await con.fetch(command)
-        embed = await self.get_voice_embed(ctx, selection, entries=entries, interval=interval)
-        plot = graphs.plot_24_hour_voice(entries=entries)
+            summary = await queries.VoiceSummary.fetch(con, selection.get_condition(), interval)
+        embed = self.get_voice_embed(ctx, selection, summary, interval=interval)
+        plot = await self.render_cached(
+            (selection.get_condition(), interval, self.watermark('Voice'), '24_hour_voice'),
+            graphs.plot_24_hour_voice,
+            *summary.occupancy(),
+        )
         embed.set_image(url='attachment://graph.png')
-        return await ctx.send(embed=embed, file=discord.File(fp=plot, filename='graph.png'))
-
-    async def get_voice_embed(self, ctx, selection, *, interval='24 Hours', entries=None):
-        if entries is None:
-            command = "SELECT * FROM voice WHERE guild_id = {0} AND time + amount >= NOW() at time zone 'utc' - INTERVAL '{1}';"
-            command = command.format(selection.get_condition(), interval)
-            async with db.MaybeAcquire(pool=self.bot.pool) as con:
-                entries = await con.fetch(command)
+        return await ctx.send(embed=embed, file=discord.File(fp=io.BytesIO(plot), filename='graph.png'))
 
-        description = f'Total of `{tutil.human(self.time_all(entries))}`'
+    def get_voice_embed(self, ctx, selection, summary, *, interval='24 Hours'):
+        description = f'Total of `{tutil.human(summary.total())}`'
         if not selection.is_member():
             formatted_people = []
             i = 0
-            for p, amount in self.time(entries, 'user_id', n=5):
+            for p, amount in summary.top('user_id', n=5):
                 i += 1
                 formatted_people.append(f'`{i}.` <@{p}> - `{tutil.human(amount // 1)}`')
             description += '\n\n **Voice | Top 5 Users**\n' \
@@ -266,7 +287,7 @@ class Statistics(commands.Cog):
         if not selection.is_channel():
             formatted_channels = []
             i = 0
-            for c, amount in self.time(entries, 'channel_id', n=5):
+            for c, amount in summary.top('channel_id', n=5):
                 i += 1
                 formatted_channels.append(f'`{i}.` <#{c}> - `{tutil.human(amount // 1)}`')
             description += '\n\n**Voice | Top 5 Channels**\n' + '\n'.join(formatted_channels)
@@ -276,42 +297,13 @@ class Statistics(commands.Cog):
         )
         return embed
 
-    def time(self, entries, key, *, n=10):
-        time = Counter()
-        for e in entries:
-            if e[key] is not None:
-                time[e[key]] += e['amount'].total_seconds()
-        return time.most_common(n)
-
-    def time_all(self, entries):
-        i = 0
-        for e in entries:
-            i += e['amount'].total_seconds()
-        return i
-
-    def count(self, entries, key, *, n=10):
-        people = Counter()
-        for e in entries:
-            if e[key] is not None:
-                people[e[key]] += e['amount']
-        return people.most_common(n)
-
-    def count_all(self, entries):
-        i = 0
-        for e in entries:
-            if e['channel_id'] is not None or (e['channel_id'] is None and e['user_id'] is None):
-                i += e['amount']
-        return i
-
-    def count_compressed(self, entries):
-        small = 0
-        big = 0
-        for e in entries:
-            if e['channel_id'] is None and e['user_id'] is None:
-                big += e['amount']
-            elif e['channel_id'] is None and e['user_id'] is not None:
-                small += e['amount']
-        return small, big
+    def bar_values(self, rows, total, get_object):
+        """Resolves names for the top rows so only plain data is sent to the renderer."""
+        values = Counter()
+        for object_id, amount in rows:
+            found = get_object(object_id)
+            values[found.name if found is not None else str(object_id)] += amount
+        return values, total - sum(amount for _, amount in rows)
 
 
 def setup(bot):
@@ -1,4 +1,10 @@
+import datetime
+import logging
+
+import bot as bot_storage
 from bot.cogs.stats import stat_config
+from bot.util import bulk
+from bot.util.spill import SpillFile
 from glocklib import database as db
 from bot.util import time_util as tutil
 import discord
@@ -8,10 +14,12 @@ from discord.ext import commands
 
 class VoiceTable(db.Table, table_name='voice'):
     guild_id = db.Column(db.Integer(big=True), index=True, nullable=False)
-    channel_id = db.Column(db.Integer(big=True), nullable=False)
-    user_id = db.Column(db.Integer(big=True), nullable=False)
+    # Flattened rows don't have a channel or user
+    channel_id = db.Column(db.Integer(big=True), nullable=True)
+    user_id = db.Column(db.Integer(big=True), nullable=True)
     time = db.Column(db.Datetime(), nullable=False, default="now() at time zone 'utc'")
     amount = db.Column(db.Interval(), default="'1 minute'", nullable=False)
+    interval = db.Column(db.Interval(), default="INTERVAL '30 MINUTES'")
 
     @classmethod
     def create_table(cls, *, overwrite=False):
@@ -20,11 +28,58 @@ class VoiceTable(db.Table, table_name='voice'):
         # create the constraints
         sql = 'ALTER TABLE voice DROP CONSTRAINT IF EXISTS unique_voice; ALTER TABLE voice ADD CONSTRAINT unique_voice UNIQUE (channel_id, user_id, time);'
 
-        return '{0}\n{1}'.format(statement, sql)
+        # Tables from before flattening
+        columns = "ALTER TABLE voice ALTER COLUMN channel_id DROP NOT NULL;" \
+                  "ALTER TABLE voice ALTER COLUMN user_id DROP NOT NULL;" \
+                  "ALTER TABLE voice ADD COLUMN IF NOT EXISTS interval INTERVAL DEFAULT INTERVAL '30 MINUTES';"
+
+        index = 'CREATE UNIQUE INDEX IF NOT EXISTS voice_uniq_idx ' \
+                'ON voice (guild_id, COALESCE(channel_id, 0), COALESCE(user_id, 0), time);'
+
+        return '{0}\n{1}\n{2}\n{3}'.format(statement, columns, sql, index)
+
+
+class VoiceStagingTable(db.Table, table_name='voice_staging'):
+    guild_id = db.Column(db.Integer(big=True), nullable=False)
+    channel_id = db.Column(db.Integer(big=True), nullable=False)
+    user_id = db.Column(db.Integer(big=True), nullable=False)
+    time = db.Column(db.Datetime(), nullable=False)
+    amount = db.Column(db.Interval(), nullable=False)
+
+    @classmethod
+    def create_table(cls, *, overwrite=False):
+        return bulk.unlogged(super().create_table(overwrite=overwrite))
+
+
+# Staged rows are time that hasn't been written yet, so they get added on
+MERGE = """
+WITH moved AS (
+    DELETE FROM voice_staging RETURNING *
+)
+INSERT INTO voice(guild_id, channel_id, user_id, time, amount)
+SELECT guild_id, channel_id, user_id, time, SUM(amount) FROM moved GROUP BY guild_id, channel_id, user_id, time
+ON CONFLICT ON CONSTRAINT unique_voice DO UPDATE SET amount = voice.amount + EXCLUDED.amount;
+"""
+
+writer = bulk.StagedWriter('voice_staging', ('guild_id', 'channel_id', 'user_id', 'time', 'amount'), MERGE)
+
+SLICE = datetime.timedelta(minutes=30)
+
+
+def time_slices(start, end):
+    """Splits the time between start and end into the 30 minute buckets that it covers."""
+    if end <= start:
+        # Stops are rounded while checkpoints aren't, so a stop can land just before the last checkpoint
+        return
+    bucket = tutil.floor_time(top=30, time_like=start)
+    while bucket < end:
+        next_bucket = bucket + SLICE
+        yield bucket, min(end, next_bucket) - max(start, bucket)
+        bucket = next_bucket
 
 
 class VoiceLog:
-    __slots__ = ('member_id', 'channel_id', 'guild_id', 'start', 'stop')
+    __slots__ = ('member_id', 'channel_id', 'guild_id', 'start', 'stop', 'checkpoint')
 
     def __init__(self, member_id, channel_id, guild_id):
         self.member_id = member_id
@@ -32,6 +87,8 @@ class VoiceLog:
         self.guild_id = guild_id
         self.start = tutil.round_time(tutil.get_utc(), 1)
         self.stop = None
+        # Everything before this has been written to the database
+        self.checkpoint = self.start
 
     def has_stopped(self):
         return self.stop is not None
@@ -44,14 +101,88 @@ class VoiceLog:
             return self.stop
         return tutil.get_utc()
 
+    def is_written(self):
+        return self.has_stopped() and self.checkpoint >= self.stop
+
+    def slices(self, end):
+        """Time that hasn't been written yet, split up into buckets."""
+        return time_slices(self.checkpoint, end)
+
+    def to_record(self):
+        return self.member_id, self.channel_id, self.guild_id, self.start, self.stop, self.checkpoint
+
+    @classmethod
+    def from_record(cls, record, stopped):
+        member_id, channel_id, guild_id, start, stop, checkpoint = record
+        log = cls(member_id, channel_id, guild_id)
+        log.start = datetime.datetime.fromisoformat(start)
+        log.checkpoint = datetime.datetime.fromisoformat(checkpoint)
+        # Sessions that were open when the bot went down are closed at the last time they were written
+        log.stop = datetime.datetime.fromisoformat(stop) if stop is not None else max(stopped, log.checkpoint)
+        return log
+
+
+class VoiceSessions:
+    """
+    Voice sessions waiting to be pushed.
+
+    Open sessions are stored by (guild_id, member_id) so a voice state change never has to look through every
+    session. Closed sessions wait in their own list until a push stores them.
+    """
+
+    def __init__(self):
+        self.open = {}
+        self.closed = []
+
+    def __len__(self):
+        return len(self.open) + len(self.closed)
+
+    def __iter__(self):
+        yield from self.closed
+        yield from self.open.values()
+
+    def start(self, voice_log):
+        self.stop(voice_log.guild_id, voice_log.member_id)
+        self.open[(voice_log.guild_id, voice_log.member_id)] = voice_log
+
+    def stop(self, guild_id, member_id):
+        """Closes the member's open session, if they have one."""
+        voice_log = self.open.pop((guild_id, member_id), None)
+        if voice_log is None:
+            return None
+        voice_log.force_stop()
+        self.closed.append(voice_log)
+        return voice_log
+
+    def add(self, voice_log):
+        if voice_log.has_stopped():
+            self.closed.append(voice_log)
+        else:
+            self.start(voice_log)
+
+    def take_closed(self):
+        closed, self.closed = self.closed, []
+        return closed
+
+    def restore_closed(self, closed):
+        self.closed = closed + self.closed
+
 
 class Voice(commands.Cog):
     """Tracks voice chat using the bot."""
 
     def __init__(self, bot):
         self.bot: synth_bot.SynthBot = bot
-        self.cache = []
+        self.sessions = VoiceSessions()
+        self.spill = SpillFile(
+            bot_storage.config.get('spill_directory', 'data/spill'),
+            'voice',
+            max_bytes=bot_storage.config.get('spill_max_bytes', 64 * 1024 * 1024),
+        )
+        self.replay()
         self.setup = False
+        # Whatever was written before the reload isn't known about
+        self.bot.data_changed('Voice')
         self.bot.add_loop('voiceupdate', self.update_loop)
 
     async def update_loop(self, time):
@@ -63,34 +194,56 @@ class Voice(commands.Cog):
 
     def cog_unload(self):
         self.bot.remove_loop('voiceupdate')
+        self.spill.close()
+
+    def replay(self):
+        stopped = self.spill.last_written() or tutil.get_utc()
+        sessions = {}
+        for record in self.spill.replay():
+            key = (record[0], record[3])
+            # A session gets a record when it opens, closes, and after pushes. The one furthest along wins.
+            if key not in sessions or (record[5], record[4] is not None) >= (sessions[key][5], sessions[key][4] is not None):
+                sessions[key] = record
+        for record in sessions.values():
+            voice_log = VoiceLog.from_record(record, stopped)
+            if not voice_log.is_written():
+                self.sessions.add(voice_log)
+
+    def log(self, voice_log):
+        if self.spill.append(*voice_log.to_record()):
+            return True
+        logging.warning('Voice spill is full, dropped a session')
+        return False
 
     async def push(self):
-        if not self.cache:
+        if not self.sessions:
             return
-        elements = []
-        element_format = '({0}, {1}, {2}, {3}, {4})'
-        for cached in self.cache:
-            dif = cached.stopped_or_now() - cached.start
-            minutes = dif.total_seconds() // 60
-            if minutes < 1:
+        closed = self.sessions.take_closed()
+        now = tutil.get_utc()
+        records = []
+        checkpoints = []
+        for cached in closed + list(self.sessions.open.values()):
+            end = cached.stop if cached.has_stopped() else now
+            if (end - cached.start).total_seconds() < 60:
                 continue
-            time_str = cached.start.strftime("'%Y-%m-%d %H:%M:%S'")
-            elements.append(
-                element_format.format(
-                    cached.guild_id,
-                    cached.channel_id,
-                    cached.member_id,
-                    time_str,
-                    "'{0} SECONDS'".format(dif.total_seconds()),
-                ),
-            )
-        if not elements:
-            return
-        command = 'INSERT INTO voice(guild_id, channel_id, user_id, time, amount) VALUES {0} ON CONFLICT ON CONSTRAINT unique_voice DO UPDATE SET amount = EXCLUDED.amount;'
-        command = command.format(', '.join(elements))
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            await con.execute(command)
-        self.cache = [cached for cached in self.cache if not cached.has_stopped()]  # noqa: WPS441
+            for bucket, amount in cached.slices(end):
+                records.append((cached.guild_id, cached.channel_id, cached.member_id, bucket, amount))
+            checkpoints.append((cached, end))
+        segments = self.spill.rotate()
+        try:
+            async with db.MaybeAcquire(pool=self.bot.pool) as con:
+                await writer.write(con, records)
+        except Exception:
+            self.sessions.restore_closed(closed)
+            self.spill.compact(segments, [cached.to_record() for cached in self.sessions])
+            raise
+        for cached, end in checkpoints:
+            cached.checkpoint = end
+        # Closed sessions are written once more so that an older record of them left in the spill doesn't get
+        # replayed. They're gone after the next push.
+        written = [cached for cached in closed if cached.is_written()]
+        self.spill.compact(segments, [cached.to_record() for cached in (*written, *self.sessions)])
+        self.bot.data_changed('Voice')
 
     @commands.command(name='*voicepush', hidden=True)
     @commands.is_owner()
@@ -125,29 +278,29 @@ class Voice(commands.Cog):
             await self.update_switch(member, after, after)
             return
 
+    def stop_session(self, member):
+        voice_log = self.sessions.stop(member.guild.id, member.id)
+        if voice_log is not None:
+            self.log(voice_log)
+
     async def update_disconnect(self, member, after, before):
-        for cached in self.cache:
-            if cached.member_id == member.id and not cached.has_stopped():
-                cached.force_stop()
+        self.stop_session(member)
 
     async def update_new(self, member, after, before):
-        self.cache.append(VoiceLog(
-            member.id,
-            after.channel.id,
-            after.channel.guild.id,
-        ))
+        self.start_session(member.id, after.channel)
+
+    def start_session(self, member_id, channel):
+        if (channel.guild.id, member_id) in self.sessions.open:
+            return
+        voice_log = VoiceLog(member_id, channel.id, channel.guild.id)
+        if self.log(voice_log):
+            self.sessions.start(voice_log)
 
     async def update_switch(self, member, after, before):
-        for cached in self.cache:
-            if cached.member_id == member.id and not cached.has_stopped():
-                cached.force_stop()
+        self.stop_session(member)
         if not await self.should_member_log(member, after.channel):
             return
-        self.cache.append(VoiceLog(
-            member.id,
-            after.channel.id,
-            after.channel.guild.id,
-        ))
+        self.start_session(member.id, after.channel)
 
     async def setup_voice(self):
         for guild in self.bot.guilds:
@@ -157,7 +310,7 @@ class Voice(commands.Cog):
     async def _set_channel(self, voice):
         for member in voice.members:
             if await self.should_member_log(member, voice):
-                self.cache.append(VoiceLog(member.id, voice.id, voice.guild.id))
+                self.start_session(member.id, voice)
 
 
 def setup(bot):
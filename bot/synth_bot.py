@@ -1,12 +1,17 @@
 import math
 import traceback
+from collections import Counter
 from datetime import datetime
 
 import bot
 import glocklib.bot as gbot
 from bot.cogs import guild_config
+from bot.cogs.stats import messages
 from glocklib import database as db
+from bot.util import statements
 from bot.util import time_util as tutil
+from bot.util.render import GraphRenderer
+from bot.util.storage_cache import SizedLRU
 import discord
 from glocklib import context as Context
 from discord.ext import commands, tasks
@@ -21,6 +26,11 @@ startup_extensions = [
 description = 'The open source discord statistic bot.'
 main_color = discord.Colour(0x9d0df0)
 
+PRESENCE = statements.register(
+    'presence',
+    "SELECT SUM(amount) FROM messages WHERE time >= NOW() at time zone 'utc' - INTERVAL '24 HOURS';",
+)
+
 error_timeout = 15
 settings_cache = 640
 send_error = (
@@ -74,6 +84,15 @@ class SynthBot(gbot.Bot):
             allowed_mentions=allowed_mentions,
         )
         self.boot = datetime.now()
+        self.renderer = GraphRenderer(
+            workers=bot.config.get('render_workers', 2),
+            max_queue=bot.config.get('render_queue', 16),
+            timeout=bot.config.get('render_timeout', 30),
+        )
+        self.graph_cache = SizedLRU(bot.config.get('graph_cache_bytes', 32 * 1024 * 1024))
+        # Bumped whenever a cog writes statistics, so cached summaries and graphs know they're out of date. Kept on
+        # the bot so that reloading a cog doesn't start it over.
+        self.data_versions = Counter()
         for extension in startup_extensions:
             try:
                 self.load_extension('{0}.{1}'.format(cogs_dir, extension))
@@ -86,6 +105,10 @@ class SynthBot(gbot.Bot):
     def run(self):
         super().run(bot.config['bot_token'], reconnect=True)
 
+    async def close(self):
+        self.renderer.close()
+        await super().close()
+
     async def get_guild_prefix(self, guild):
         settings = await guild_config.get_guild_settings(self, guild)
         if not settings:
@@ -97,6 +120,10 @@ class SynthBot(gbot.Bot):
         await self.update_presence()
         logging.info('Bot up and running!')
 
+    def data_changed(self, *cog_names):
+        for cog_name in cog_names:
+            self.data_versions[cog_name] += 1
+
     def add_loop(self, name, function):
         """
         Adds a loop to the thirty minute loop. Needs to take in a function with a parameter time with async.
@@ -142,11 +169,14 @@ class SynthBot(gbot.Bot):
             await self.update_presence()
 
     async def update_presence(self):
-        command = "SELECT SUM(amount) FROM messages WHERE time >= NOW() at time zone 'utc' - INTERVAL '24 HOURS';"
-        async with db.MaybeAcquire(pool=self.pool) as con:
-            entry = await con.fetchrow(command)
-        if entry['sum'] is None:
-            amount = 0
+        rolling = messages.get_rolling(self)
+        if rolling is not None:
+            amount = rolling.get_total()
         else:
-            amount = entry['sum']
+            async with db.MaybeAcquire(pool=self.pool) as con:
+                entry = await PRESENCE.fetchrow(con)
+            if entry['sum'] is None:
+                amount = 0
+            else:
+                amount = entry['sum']
         await self.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name="{0} messages".format(amount)))
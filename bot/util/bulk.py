@@ -0,0 +1,32 @@
+"""
+Bulk writes through an unlogged staging table.
+
+Records are streamed with COPY instead of being formatted into a statement, then a single merge statement moves
+them out of the staging table into the real tables.
+"""
+
+
+def unlogged(statement):
+    """Makes a create table statement from glocklib create an unlogged table."""
+    return statement.replace('CREATE TABLE', 'CREATE UNLOGGED TABLE', 1)
+
+
+class StagedWriter:
+    """
+    Copies records into a staging table and merges them inside of one transaction.
+
+    The merge statement should start with deleting everything from the staging table. Rows that were copied are
+    only visible to the transaction that copied them, so writers on other connections never merge each other's rows.
+    """
+
+    def __init__(self, staging, columns, merge):
+        self.staging = staging
+        self.columns = columns
+        self.merge = merge
+
+    async def write(self, connection, records):
+        if not records:
+            return
+        async with connection.transaction():
+            await connection.copy_records_to_table(self.staging, records=records, columns=self.columns)
+            await connection.execute(self.merge)
@@ -27,3 +27,6 @@ class Config:    # noqa: WPS110
 
     def __contains__(self, item):    # noqa: WPS110
         return item in self.data
+
+    def get(self, item, default=None):    # noqa: WPS110
+        return self.data.get(item, default)
@@ -2,72 +2,59 @@ import seaborn as sns
 from matplotlib import pyplot as plt
 from matplotlib import dates as md
 from io import BytesIO
-from datetime import datetime, timedelta, date
-from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
 from bot.util import time_util as tutil
 from bot.synth_bot import main_color
-import random
-import pandas as pd
+import numpy as np
 
 
-def lock_24_hours(entries, *, time=False):
-    data = Counter()
-    min_date = datetime.now()
-    max_date = datetime.now() - timedelta(hours=1)
-    for e in entries:
-        if e['channel_id'] is None and e['user_id'] is None:
-            continue
-        elif e['channel_id'] is None and e['user_id'] is not None:
-            continue
-        min_date = min(min_date, e['time'])
-        max_date = max(max_date, e['time'])
-        if time:
-            data[e['time']] += e['amount'].total_seconds()
-        else:
-            data[e['time']] += e['amount']
-    if (max_date - min_date).days > 0:
-        days = True
-        keys = [k for k in data.keys()]
-        for k in keys:
-            data[datetime.combine(date.min, k.time()) - datetime.min] = data.pop(k)
-        min_date = timedelta(days=0)
-        data[min_date] = 0
-        max_date = timedelta(days=1)
-        data[max_date] = 0
-    else:
-        days = False
-        keys = [k for k in data.keys()]
-        for k in keys:
-            data[datetime.combine(date.min, k.time()) - datetime.min] = data.pop(k)
-        max_date = timedelta(days=1)
-        min_date = timedelta(days=0)
-        data[max_date] = 0
-        data[min_date] = 0
-    return data, min_date, max_date, days
-
-
-def plot_24_hour_messages(entries):
-    # Amount of messages per time
-    data, min_date, max_date, days = lock_24_hours(entries)
-    y = []
-    for d, amount in data.items():
-        y.extend([d.total_seconds() // (60 * 60)] * amount)
-    if days:
-        y.sort()
+def weighted_kde(values, weights, grid, *, bandwidth=None, min_bandwidth=0):
+    """
+    A gaussian KDE where every value stands in for `weight` data points.
+
+    Buckets are passed in with how many messages they hold, so this scales with the amount of buckets and not the
+    amount of messages. `min_bandwidth` should be about half a bucket, since the data inside a bucket is spread out
+    and a single bucket would otherwise make a spike.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    total = weights.sum()
+    if total <= 0:
+        return np.zeros(len(grid))
+    if bandwidth is None:
+        # Scott's rule with the weighted standard deviation and the effective sample size
+        mean = np.average(values, weights=weights)
+        deviation = np.sqrt(np.average((values - mean) ** 2, weights=weights))
+        effective = total ** 2 / (weights ** 2).sum()
+        bandwidth = max(deviation * effective ** (-1 / 5), min_bandwidth, 1e-3)
+    distance = (np.asarray(grid, dtype=np.float64)[:, None] - values[None, :]) / bandwidth
+    return np.exp(-0.5 * distance ** 2) @ weights / (total * bandwidth * np.sqrt(2 * np.pi))
+
+
+def plot_24_hour_messages(hours, *, days=False):
+    # Amount of messages per hour of the day, hours is an array of the amount for each hour
+    x = np.arange(24)
+    y = np.asarray(hours, dtype=np.float64)
     sns.set_theme(style="ticks", context="paper")
     plt.style.use("dark_background")
     plt.figure()
-    random.seed(len(entries))
-    strip = [random.uniform(-.5, .5) + i for i in y]
-    random.seed()
-    ax = sns.swarmplot(x=strip, color='.2', alpha=0.9, size=3)
-    ax = sns.violinplot(x=y, inner=None, palette='Blues')
-    ax.set_xlim(min_date.total_seconds() // (60 * 60), max_date.total_seconds() // (60 * 60))
+    ax = plt.gca()
+    ax.bar(x, y, width=1, align='edge', color=sns.color_palette('Blues', 24), alpha=0.9)
+    if y.sum() > 0:
+        # Messages are spread out over the hour they were sent in
+        grid = np.linspace(0, 24, 24 * 12 + 1)
+        density = weighted_kde(x + 0.5, y, grid, min_bandwidth=0.5)
+        ax.plot(grid, density * y.sum(), color=str(main_color), linewidth=2)
+    ax.set_xlim(0, 24)
     utc = tutil.get_utc()
     ax.set_xticks([i for i in range(24)])
     ax.set_xticklabels(['{0}:00'.format(i) for i in range(24)])
     ax.tick_params(axis="x", rotation=45)
-    ax.text(utc.hour + (utc.minute / 60), 0.47, 'Now')
+    ax.set(ylabel='Messages')
+    if not days:
+        now = utc.hour + (utc.minute / 60)
+        ax.axvline(now, color='white', alpha=0.3)
+        ax.text(now, ax.get_ylim()[1], 'Now', va='bottom')
 
     ax.spines['top'].set_visible(False)
     ax.spines['right'].set_visible(False)
@@ -77,49 +64,59 @@ def plot_24_hour_messages(entries):
     plt.savefig(buffer, format='png', transparent=True, bbox_inches='tight')
     plt.clf()
     plt.close()
-    buffer.seek(0)
-    return buffer
-
-
-def plot_week_messages(entries):
-    # Amount of messages per time
-    min_date = datetime.now()
-    max_date = datetime.now() - timedelta(hours=1)
-    now = datetime.now().date()
-    data = []
-    order_data = {}
-    for e in entries:
-        if e['channel_id'] is None and e['user_id'] is None:
-            continue
-        elif e['channel_id'] is None and e['user_id'] is not None:
-            continue
-        days = (now - e['time'].date()).days
-        if days > 7:
-            continue
-        min_date = min(min_date, e['time'])
-        max_date = max(max_date, e['time'])
-        order_data[days] = e['time'].strftime('%A')
-        for i in range(e['amount']):
-            data.append((
-                e['time'].strftime('%A'),
-                (datetime.combine(date.min, e['time'].time()) - datetime.min).total_seconds(),
-            ))
-    order = [v for i, v in sorted(order_data.items(), key=lambda item: item[0], reverse=True)]
-    df = pd.DataFrame(data, columns=['Days', 'Amount'])
-
-    diff = (max_date - min_date).days
-    if diff < 2:
+    return buffer.getvalue()
+
+
+def week_span(week):
+    """Amount of days that the week graph would cover."""
+    days, seconds, _ = week
+    now = np.datetime64(tutil.get_utc(), 's')
+    times = days.astype('datetime64[s]') + seconds.astype('timedelta64[s]')
+    min_date = min(now, times.min()) if len(times) else now
+    max_date = max(now - np.timedelta64(1, 'h'), times.max()) if len(times) else now - np.timedelta64(1, 'h')
+    return int((max_date - min_date) // np.timedelta64(1, 'D'))
+
+
+def daily_span(daily):
+    """Amount of days that the daily graph would cover."""
+    days, _ = daily
+    if not len(days):
+        return 0
+    now = np.datetime64(tutil.get_utc().date(), 'D')
+    return max(0, int((now - days.min()).astype(np.int64)))
+
+
+def plot_week_messages(week):
+    # Amount of messages per time, week is made up of (day, seconds into the day, amount)
+    if week_span(week) < 2:
         return None
+    now = tutil.get_utc()
+    week_days, week_seconds, week_amounts = week
+    order = [day.astype(datetime) for day in np.unique(week_days)]
+    days = {day: (week_seconds[week_days == day], week_amounts[week_days == day]) for day in order}
 
     min_date = timedelta(days=0)
     max_date = timedelta(days=1)
+    grid = np.linspace(min_date.total_seconds(), max_date.total_seconds(), 24 * 12 + 1)
+    densities = [weighted_kde(*days[day], grid, min_bandwidth=30 * 60) * days[day][1].sum() for day in order]
+    # Like a violin plot scaled by count, the busiest day gets the widest violin
+    widest = max(density.max() for density in densities) or 1
 
     sns.set_theme(style="ticks", context="paper")
     plt.style.use("dark_background")
     plt.figure()
-    ax = sns.violinplot(y='Days', x='Amount', data=df, inner='stick', palette='Blues', order=order, scale_hue=False, scale='count')
+    ax = plt.gca()
+    colors = sns.color_palette('Blues', len(order))
+    for index, (day, density, color) in enumerate(zip(order, densities, colors)):
+        width = density / widest * 0.45
+        ax.fill_between(grid, index - width, index + width, color=color, linewidth=0)
+        # Stick for every bucket, like inner='stick'
+        ax.vlines(days[day][0], index - 0.45, index + 0.45, color='.2', alpha=0.3, linewidth=0.5)
+    ax.set_yticks(range(len(order)))
+    ax.set_yticklabels([day.strftime('%A') for day in order])
+    ax.set_ylim(len(order) - 0.5, -0.5)
+    ax.set(ylabel='Days', xlabel='Amount')
     ax.set_xlim(min_date.total_seconds(), max_date.total_seconds())
-    now = tutil.get_utc()
     ax.set_xticks([3600 * i for i in range(24)] + [now.hour / 60])
     ax.set_xticklabels(['{0}:00'.format(i) for i in range(24)] + ['Now'])
     ax.tick_params(axis='x', rotation=45)
@@ -132,36 +129,21 @@ def plot_week_messages(entries):
     plt.savefig(buffer, format='png', transparent=True, bbox_inches='tight')
     plt.clf()
     plt.close()
-    buffer.seek(0)
-    return buffer
-
+    return buffer.getvalue()
 
-def plot_daily_message(entries):
-    messages = Counter()
-    names = {}
-    now = tutil.get_utc().date()
-    max_days = 0
-    for e in entries:
-        days = -1 * (now - e['time'].date()).days
-        if e['channel_id'] is None and e['user_id'] is None:
-            messages[days] += e['amount']
-        elif e['user_id'] is not None:
-            messages[days] += e['amount']
-        else:
-            continue
 
-        max_days = max(max_days, days * -1)
+def plot_daily_message(daily):
+    # daily is made up of an array of days and an array of amounts
+    max_days = daily_span(daily)
     if max_days < 3:
         return None
-    x = []
-    y = []
-    for day in range(max_days + 1):
-        day = day - max_days
-        val = messages[day]
-        x.append(day)
-        y.append(val)
-        if day not in names:
-            names[day] = (now + timedelta(days=day)).strftime('%m/%d')
+    days, amounts = daily
+    now = tutil.get_utc().date()
+    x = np.arange(-max_days, 1)
+    y = np.zeros(max_days + 1, dtype=np.int64)
+    # Days ago is negative, so shift it over to be an index
+    np.add.at(y, (days - np.datetime64(now, 'D')).astype(np.int64) + max_days, amounts)
+    names = {day: (now + timedelta(days=int(day))).strftime('%m/%d') for day in x}
     sns.set_theme(style="ticks", context="paper")
     plt.style.use("dark_background")
     plt.figure()
@@ -179,34 +161,13 @@ def plot_daily_message(entries):
     plt.savefig(buffer, format='png', transparent=True, bbox_inches='tight')
     plt.clf()
     plt.close()
-    buffer.seek(0)
-    return buffer
-
-
-def plot_message_channel_bar(ctx, entries):
-    lost = 0
-    channels = Counter()
-    id_to_name = {}
-    for e in entries:
-        channel_id = e['channel_id']
-        if channel_id is None and e['user_id'] is None:
-            lost += e['amount']
-        elif channel_id is not None:
-            if channel_id not in id_to_name:
-                channel = ctx.guild.get_channel(channel_id)
-                if channel is not None:
-                    id_to_name[channel_id] = channel.name
-                else:
-                    id_to_name[channel_id] = str(channel_id)
-            channels[id_to_name[channel_id]] += e['amount']
-    return plot_bar(channels)
-
-
-def plot_bar(values):
+    return buffer.getvalue()
+
+
+def plot_bar(values, *, other=0):
     name = []
     amount = []
     i = 0
-    other = 0
     for c, a in sorted(values.items(), key=lambda item: item[1], reverse=True):
         if i >= 9:
             other += a
@@ -230,65 +191,61 @@ def plot_bar(values):
     ax.spines['right'].set_visible(False)
     buffer = BytesIO()
     plt.savefig(buffer, format='png', transparent=True, bbox_inches='tight')
-    buffer.seek(0)
     plt.clf()
     plt.close()
+    return buffer.getvalue()
+
+
+VOICE_BUCKET = 30 * 60
+
+
+def voice_occupancy(starts, seconds, users):
+    """
+    Counts how many different users were in voice during each 30 minute bucket.
+
+    Takes arrays of start times, seconds, and user IDs. Returns the bucket start times and the counts.
+    """
+    if not len(starts):
+        return np.array([], dtype='datetime64[s]'), np.array([], dtype=np.int64)
+    starts = np.asarray(starts, dtype='datetime64[s]').astype(np.int64)
+    # Starts are rounded to the closest bucket, and each one covers what's left of the session
+    first = (starts + VOICE_BUCKET // 2) // VOICE_BUCKET
+    lengths = np.ceil(np.asarray(seconds, dtype=np.float64) / VOICE_BUCKET).astype(np.int64).clip(min=0)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    buckets = np.repeat(first, lengths) + offsets
+    users = np.repeat(np.asarray(users, dtype=np.int64), lengths)
+    # A user only counts once per bucket
+    order = np.lexsort((users, buckets))
+    buckets = buckets[order]
+    users = users[order]
+    unique = np.ones(len(buckets), dtype=bool)
+    unique[1:] = (buckets[1:] != buckets[:-1]) | (users[1:] != users[:-1])
+    buckets, counts = np.unique(buckets[unique], return_counts=True)
+    return (buckets * VOICE_BUCKET).astype('datetime64[s]'), counts
+
 
-    return buffer
-
-
-def plot_message_user_bar(ctx, entries):
-    lost = 0
-    users = Counter()
-    id_to_name = {}
-    for e in entries:
-        user_id = e['user_id']
-        if user_id is None and e['channel_id'] is None:
-            lost += e['amount']
-        elif user_id is not None:
-            if user_id not in id_to_name:
-                user = ctx.guild.get_member(user_id)
-                if user is not None:
-                    id_to_name[user_id] = user.name
-                else:
-                    id_to_name[user_id] = str(user_id)
-            users[id_to_name[user_id]] += e['amount']
-    return plot_bar(users)
-
-
-def plot_24_hour_voice(entries):
-    data = Counter()
-    logged = {}
-    min_date = datetime.now()
-    max_date = datetime.now() - timedelta(hours=1)
-    data[datetime.now()] = 0
-    data[datetime.now() - timedelta(days=1)] = 0
-    for e in entries:
-        time = tutil.round_time(e['time'], 60 * 30)
-        added = 0
-        min_date = min(min_date, e['time'])
-        while added < e['amount'].total_seconds():
-            max_date = max(max_date, time)
-            if time not in logged:
-                logged[time] = []
-            if e['user_id'] not in logged[time]:
-                data[time] += 1
-                logged[time].append(e['user_id'])
-            time = time + timedelta(minutes=30)
-            added += 60 * 30
+def plot_24_hour_voice(starts, seconds, users):
+    # Arrays of when each entry started, how long it was, and who it was
+    times, counts = voice_occupancy(starts, seconds, users)
+    now = datetime.now()
+    min_date = now
+    max_date = now - timedelta(hours=1)
+    if len(times):
+        min_date = min(min_date, np.min(starts).astype('datetime64[us]').astype(datetime))
+        max_date = max(max_date, times[-1].astype(datetime))
     if (max_date - min_date).days > 0:
-        keys = [k for k in data.keys()]
-        for k in keys:
-            data[k.replace(year=2020, month=1, day=1)] = data.pop(k)
+        # Lay every day on top of each other and show the most that were in voice at that time of day
+        day = np.datetime64('2020-01-01T00:00:00')
+        time_of_day = (times - times.astype('datetime64[D]')).astype(np.int64) // VOICE_BUCKET
+        peak = np.zeros(24 * 60 * 60 // VOICE_BUCKET, dtype=np.int64)
+        np.maximum.at(peak, time_of_day, counts)
+        times = day + np.arange(len(peak)) * np.timedelta64(VOICE_BUCKET, 's')
+        counts = peak
         min_date = datetime(year=2020, month=1, day=1, minute=0, hour=0, second=0, microsecond=0)
-        data[min_date] = 0
         max_date = datetime(year=2020, month=1, day=2, minute=0, hour=0, second=0, microsecond=0)
-        data[max_date] = 0
     else:
         max_date = tutil.get_utc() + timedelta(minutes=30)
         min_date = max_date - timedelta(days=1, minutes=30)
-        data[max_date] = 0
-        data[min_date] = 0
     plt.style.use('dark_background')
     fig, ax = plt.subplots(ncols=1, nrows=1)
     ax.xaxis.set_major_locator(md.HourLocator(interval=2))
@@ -303,14 +260,13 @@ def plot_24_hour_voice(entries):
 
     ax.set_xlabel('Time (UTC)')
     ax.set_ylabel('Amount in Voice Channel')
-    _ = ax.bar(data.keys(), data.values(), width=1 / 48, alpha=1, align='edge', edgecolor=str(main_color),
+    _ = ax.bar(times.astype('datetime64[us]').astype(datetime), counts, width=1 / 48, alpha=1, align='edge', edgecolor=str(main_color),
                color=str(main_color))
     fig.autofmt_xdate()
 
     plt.xlim([min_date, max_date])
     buffer = BytesIO()
     fig.savefig(buffer, format='png', transparent=True, bbox_inches='tight')
-    buffer.seek(0)
     fig.clear()
     plt.close(fig)
-    return buffer
+    return buffer.getvalue()
@@ -1,5 +1,7 @@
-import contextlib
+import asyncio
+import functools
 import io
+import logging
 
 import discord
 from discord.ext import menus
@@ -8,41 +10,70 @@ from glocklib.paginator import Pages
 
 class ImagePaginatorSource(menus.ListPageSource):
 
-    def __init__(self, embed, images):
+    def __init__(self, embed, images, *, prefetch=True):
+        """
+        Images can either be PNG bytes or a coroutine function that produces PNG bytes.
+
+        Producers are only ran once their page is first shown. If prefetch is enabled the next page gets made in the
+        background while the current one is being looked at.
+        """
         super().__init__(images, per_page=1)
         self.embed: discord.Embed = embed
         self.images = images
+        self.prefetch = prefetch
+        self.rendered = {}
+
+    def _render(self, page_number):
+        task = self.rendered.get(page_number)
+        if task is None:
+            image = self.images[page_number]
+            if isinstance(image, bytes):
+                task = asyncio.get_event_loop().create_future()
+                task.set_result(image)
+            else:
+                task = asyncio.ensure_future(image())
+                task.add_done_callback(functools.partial(self._render_done, page_number))
+            self.rendered[page_number] = task
+        return task
+
+    def _render_done(self, page_number, task):
+        if task.cancelled():
+            error = None
+        else:
+            error = task.exception()
+            if error is None:
+                return
+            # Prefetched pages might never be awaited, so their errors have to be picked up here
+            logging.warning('Rendering a page failed', exc_info=error)
+        # Failed pages get made again the next time they're shown instead of failing forever
+        if self.rendered.get(page_number) is task:
+            self.rendered.pop(page_number)
 
     async def format_page(self, menu, page):
-        image, fp = page
+        image = await self._render(menu.current_page)
+        if self.prefetch and menu.current_page + 1 < len(self.images):
+            self._render(menu.current_page + 1)
         maximum = self.get_max_pages()
         embed = self.embed.copy()
         if maximum > 1:
             embed.set_footer(
                 text='Page {0}/{1} ({2} images)'.format(menu.current_page + 1, maximum, str(len(self.entries))),
             )
-        embed.set_image(url='attachment://{0}'.format(image.filename))
-        # Make sure we're good to read
-        image.fp = io.BytesIO(fp.read())
-        fp.seek(0)
-        image.fp.seek(0)
-        return {'embed': embed, 'file': image}
+        filename = 'graph{0}.png'.format(menu.current_page)
+        embed.set_image(url='attachment://{0}'.format(filename))
+        return {'embed': embed, 'file': discord.File(fp=io.BytesIO(image), filename=filename)}
 
-    async def finalize(self, time_out):
-        for image, fp in self.images:
-            image.fp.close()
-            fp.close()
+    def cancel(self):
+        for task in list(self.rendered.values()):
+            task.cancel()
 
 
 class ImagePaginator(Pages):
 
-    def __init__(self, embed, images):
+    def __init__(self, embed, images, *, prefetch=True):
         self.images = images
-        self.image_files = []
         self.continued = False
-        for image_index, image in enumerate(self.images):
-            self.image_files.append((discord.File(fp=image, filename='graph{0}.png'.format(image_index)), image))
-        super().__init__(ImagePaginatorSource(embed, self.image_files))
+        super().__init__(ImagePaginatorSource(embed, self.images, prefetch=prefetch))
 
     async def send_initial_message(self, ctx, channel):
         page = await self._source.get_page(self.current_page)
@@ -60,7 +91,7 @@ class ImagePaginator(Pages):
         await super().start(ctx, channel=channel, wait=wait)
 
     async def finalize(self, timed_out):
-        if not self.continued:
-            await self.source.finalize(timed_out)
+        # Continued menus are still being looked at, unless they timed out
+        if timed_out or not self.continued:
+            self.source.cancel()
         await super().finalize(timed_out)
-
@@ -0,0 +1,160 @@
+"""
+Spreads channel renames out so they stay under Discord's rate limits.
+
+Discord only lets a channel be renamed twice every ten minutes, and anything past that gets held back by the library
+until the limit resets. Every channel gets its own token bucket so a rename that can't happen yet is deferred to the
+next refresh instead of blocking everything behind it.
+"""
+import asyncio
+import logging
+import time
+
+import discord
+
+
+class TokenBucket:
+
+    def __init__(self, capacity, per):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait_time(self):
+        """Seconds until a token is there."""
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class RenameReport:
+
+    def __init__(self, total):
+        self.total = total
+        self.edited = 0
+        self.skipped = 0
+        self.deferred = 0
+        self.failed = 0
+        self.start = time.monotonic()
+        self.end = None
+
+    def finish(self):
+        self.end = time.monotonic()
+
+    def duration(self):
+        return (self.end or time.monotonic()) - self.start
+
+    def __str__(self):
+        return '{0} renames: {1} edited, {2} unchanged, {3} deferred, {4} failed in {5:.1f}s'.format(
+            self.total, self.edited, self.skipped, self.deferred, self.failed, self.duration(),
+        )
+
+
+class RenameScheduler:
+    """
+    Renames channels with a bounded amount of workers.
+
+    :param window: Seconds that the renames of one run get spread over
+    :param per_channel: Renames a channel can have every ``channel_period`` seconds
+    :param global_rate: Renames a second across every channel
+    """
+
+    def __init__(self, *, workers=4, window=20 * 60, per_channel=2, channel_period=10 * 60, global_rate=1):
+        self.workers = workers
+        self.window = window
+        self.per_channel = per_channel
+        self.channel_period = channel_period
+        self.buckets = {}
+        self.global_bucket = TokenBucket(max(global_rate, 1), 1)
+        self.report = None
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def _bucket(self, channel_id):
+        bucket = self.buckets.get(channel_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_channel, self.channel_period)
+            self.buckets[channel_id] = bucket
+        return bucket
+
+    def _prune(self):
+        # Full buckets behave the same as new ones, so there's no point in keeping them
+        for channel_id in [channel_id for channel_id, bucket in self.buckets.items() if bucket.is_full()]:
+            self.buckets.pop(channel_id)
+
+    def start(self, renames):
+        """
+        Starts renaming in the background. ``renames`` is a list of (channel, name).
+
+        Returns the report, or None if the last run hasn't finished yet. Those renames get picked up by the next
+        refresh anyway.
+        """
+        if self.running:
+            logging.warning('Last channel renames are still going, skipping {0}'.format(len(renames)))
+            return None
+        self._prune()
+        report = RenameReport(len(renames))
+        queue = asyncio.Queue()
+        for channel, name in renames:
+            if channel.name == name:
+                report.skipped += 1
+            elif not self._bucket(channel.id).take():
+                report.deferred += 1
+            else:
+                queue.put_nowait((channel, name))
+        self.report = report
+        self._task = asyncio.get_event_loop().create_task(self._run(queue, report))
+        return report
+
+    async def wait(self):
+        if self._task is not None:
+            await asyncio.shield(self._task)
+
+    async def _run(self, queue, report):
+        spacing = self.window / max(queue.qsize(), 1)
+        workers = [
+            asyncio.get_event_loop().create_task(self._worker(queue, report, spacing * self.workers))
+            for _ in range(min(self.workers, queue.qsize()))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            report.finish()
+            logging.info(str(report))
+
+    async def _worker(self, queue, report, spacing):
+        while not queue.empty():
+            channel, name = queue.get_nowait()
+            started = time.monotonic()
+            while not self.global_bucket.take():
+                await asyncio.sleep(self.global_bucket.wait_time())
+            try:
+                await channel.edit(name=name)
+            except discord.HTTPException:
+                report.failed += 1
+            else:
+                report.edited += 1
+            if not queue.empty():
+                await asyncio.sleep(max(spacing - (time.monotonic() - started), 0))
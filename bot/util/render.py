@@ -0,0 +1,159 @@
+"""
+Renders graphs inside of a process pool so that matplotlib never blocks the event loop.
+
+Jobs only receive plain data (lists, dicts, numbers) and return PNG bytes.
+"""
+import asyncio
+import logging
+import signal
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from discord.ext import commands
+
+
+class RenderError(commands.CommandError):
+    pass
+
+
+class RenderQueueFull(RenderError):
+
+    def __init__(self):
+        super().__init__("Too many graphs are being made right now! Try again in a bit.")
+
+
+class RenderTimeout(RenderError):
+
+    def __init__(self):
+        super().__init__('Making the graph took too long!')
+
+
+def _setup_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+class _JobTimeout(Exception):
+    pass
+
+
+def _on_alarm(signum, frame):
+    raise _JobTimeout()
+
+
+def _run_job(function, args, kwargs, timeout):
+    # The deadline has to be enforced in here, the event loop giving up doesn't stop the worker
+    alarm = timeout and hasattr(signal, 'setitimer')
+    if alarm:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    start = time.perf_counter()
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        # A job cut off by the alarm never got to close its figures, and workers live for the whole pool
+        from matplotlib import pyplot as plt
+        plt.close('all')
+    return result, time.perf_counter() - start
+
+
+class RenderMetrics:
+    """Keeps track of how long jobs wait in the queue and how long they take to render."""
+
+    def __init__(self, samples=256):
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.rejected = 0
+        self.wait_times = deque(maxlen=samples)
+        self.render_times = deque(maxlen=samples)
+
+    def record(self, wait, render):
+        self.completed += 1
+        self.wait_times.append(wait)
+        self.render_times.append(render)
+
+    @staticmethod
+    def _average(values):
+        if not values:
+            return 0
+        return sum(values) / len(values)
+
+    def average_wait(self):
+        return self._average(self.wait_times)
+
+    def average_render(self):
+        return self._average(self.render_times)
+
+    def max_wait(self):
+        return max(self.wait_times, default=0)
+
+    def max_render(self):
+        return max(self.render_times, default=0)
+
+
+class GraphRenderer:
+    """
+    A bounded process pool for graph jobs.
+
+    Anything over `max_queue` pending jobs is rejected instead of piling up behind the workers.
+    """
+
+    def __init__(self, *, workers=2, max_queue=16, timeout=30):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.pending = 0
+        self.metrics = RenderMetrics()
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_setup_worker)
+        return self._executor
+
+    async def render(self, function, *args, **kwargs):
+        """
+        Runs a graph function in the pool and returns the PNG bytes (or None if the graph has nothing to show).
+        """
+        if self.pending >= self.max_queue:
+            self.metrics.rejected += 1
+            raise RenderQueueFull()
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        job = self.executor.submit(_run_job, function, args, kwargs, self.timeout)
+        self.pending += 1
+        # Only counted as done once the worker is actually free, not when we stop waiting on it
+        job.add_done_callback(lambda _: self._job_done(loop))
+        try:
+            result, render_time = await asyncio.wait_for(asyncio.wrap_future(job), timeout=self.timeout)
+        except (asyncio.TimeoutError, _JobTimeout):
+            self.metrics.timed_out += 1
+            raise RenderTimeout()
+        except Exception:
+            self.metrics.failed += 1
+            raise
+        total = time.perf_counter() - start
+        self.metrics.record(max(total - render_time, 0), render_time)
+        return result
+
+    def _job_done(self, loop):
+        # Called from the executor's thread
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            # The loop is already closed
+            pass
+
+    def _release(self):
+        self.pending -= 1
+
+    def close(self):
+        if self._executor is not None:
+            logging.info('Shutting down graph renderer...')
+            self._executor.shutdown(wait=False)
+            self._executor = None
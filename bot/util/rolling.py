@@ -0,0 +1,75 @@
+"""
+Rolling counts over the last day that live in memory.
+
+Every key has a ring of half hour buckets along with a running total, so reading a total never has to add anything
+up. Buckets are cleared as time moves past them.
+"""
+import time as time_module
+from datetime import datetime, timezone
+
+
+class RollingCounter:
+
+    def __init__(self, *, buckets=48, width=30 * 60):
+        self.buckets = buckets
+        self.width = width
+        self.rings = {}
+        self.totals = {}
+        self.ring = [0] * buckets
+        self.total = 0
+        self.current = self._bucket_number()
+
+    def _bucket_number(self, time=None):
+        if time is None:
+            seconds = time_module.time()
+        else:
+            if time.tzinfo is None:
+                # Everything in the database is naive UTC
+                time = time.replace(tzinfo=timezone.utc)
+            seconds = time.timestamp()
+        return int(seconds // self.width)
+
+    def advance(self):
+        """Clears every bucket that has fallen out of the window."""
+        now = self._bucket_number()
+        if now <= self.current:
+            return
+        steps = min(now - self.current, self.buckets)
+        for number in range(now - steps + 1, now + 1):
+            index = number % self.buckets
+            self.total -= self.ring[index]
+            self.ring[index] = 0
+            for key, ring in self.rings.items():
+                if ring[index]:
+                    self.totals[key] -= ring[index]
+                    ring[index] = 0
+        self.current = now
+        # Keys that have gone quiet for a whole day don't need to be kept
+        for key in [key for key, amount in self.totals.items() if amount == 0]:
+            self.rings.pop(key)
+            self.totals.pop(key)
+
+    def add(self, key, amount=1, *, time: datetime = None):
+        self.advance()
+        number = self.current if time is None else min(self._bucket_number(time), self.current)
+        if number <= self.current - self.buckets:
+            # Older than the window
+            return
+        index = number % self.buckets
+        ring = self.rings.get(key)
+        if ring is None:
+            ring = [0] * self.buckets
+            self.rings[key] = ring
+            self.totals[key] = 0
+        ring[index] += amount
+        self.totals[key] += amount
+        self.ring[index] += amount
+        self.total += amount
+
+    def get(self, key):
+        self.advance()
+        return self.totals.get(key, 0)
+
+    def get_total(self):
+        self.advance()
+        return self.total
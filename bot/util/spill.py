@@ -0,0 +1,103 @@
+"""
+Append only spill files for data that is waiting to be pushed to the database.
+
+Each record is one JSON line in the current segment. A push rotates to a new segment and seals the old ones, which
+are deleted once the push is stored (or compacted into one segment if it failed). Anything left over from a crash or
+a reload is replayed when the spill is opened again.
+"""
+import json
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+
+
+class SpillFile:
+
+    def __init__(self, directory, name, *, max_bytes=64 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.name = name
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._number = max((self._segment_number(path) for path in self._segments()), default=0)
+        self._file = None
+        self._path = None
+        self.size = sum(path.stat().st_size for path in self._segments())
+
+    @staticmethod
+    def _segment_number(path):
+        return int(path.stem.rsplit('-', 1)[1])
+
+    def _segments(self):
+        return sorted(self.directory.glob('{0}-*.log'.format(self.name)), key=self._segment_number)
+
+    def _new_segment(self):
+        self._number += 1
+        return self.directory / '{0}-{1}.log'.format(self.name, self._number)
+
+    def is_full(self):
+        return self.size >= self.max_bytes
+
+    def last_written(self):
+        """The UTC time the newest segment was written to, or None if there aren't any."""
+        times = [path.stat().st_mtime for path in self._segments()]
+        if not times:
+            return None
+        return datetime.utcfromtimestamp(max(times))
+
+    def replay(self):
+        """Reads every record that is still on disk. Lines cut off by a crash are skipped."""
+        for path in self._segments():
+            if path == self._path:
+                continue
+            with path.open('r') as file:
+                for line in file:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        logging.warning('Skipping broken line in {0}'.format(path))
+
+    def append(self, *record):
+        """Writes a record. Returns False if the spill is full and the record was dropped."""
+        if self.is_full():
+            self.dropped += 1
+            return False
+        if self._file is None:
+            self._path = self._new_segment()
+            # Line buffered so every record makes it to the OS right away
+            self._file = self._path.open('a', buffering=1)
+        line = json.dumps(record, default=str) + '\n'
+        self._file.write(line)
+        self.size += len(line)
+        return True
+
+    def rotate(self):
+        """Seals the current segment and returns every sealed segment."""
+        self.close()
+        return self._segments()
+
+    def discard(self, segments):
+        for path in segments:
+            try:
+                self.size -= path.stat().st_size
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def compact(self, segments, records):
+        """Replaces sealed segments with one segment holding only the records given."""
+        path = self._new_segment()
+        temporary = path.with_suffix('.tmp')
+        with temporary.open('w') as file:
+            for record in records:
+                file.write(json.dumps(record, default=str) + '\n')
+        os.replace(temporary, path)
+        self.size += path.stat().st_size
+        self.discard(segments)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._path = None
@@ -0,0 +1,94 @@
+"""
+Named, parameterised statements for the hot queries.
+
+Since the SQL for a statement never changes, asyncpg prepares it once per pooled connection and reuses the plan
+from its statement cache. Every statement keeps track of how often it's called and how long it takes.
+"""
+import bisect
+import time
+
+# Upper bounds in milliseconds
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class Statement:
+
+    def __init__(self, name, query):
+        self.name = name
+        self.query = query
+        self.calls = 0
+        self.total_time = 0
+        # The last bucket is for anything slower than the last bound
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def record(self, duration):
+        self.calls += 1
+        self.total_time += duration
+        self.histogram[bisect.bisect_left(BUCKETS, duration * 1000)] += 1
+
+    def average(self):
+        if not self.calls:
+            return 0
+        return self.total_time / self.calls
+
+    def percentile(self, percent):
+        """Gets the upper bound in milliseconds of the bucket that the percentile lands in."""
+        if not self.calls:
+            return 0
+        needed = self.calls * percent / 100
+        seen = 0
+        for index, amount in enumerate(self.histogram):
+            seen += amount
+            if seen >= needed:
+                break
+        if index >= len(BUCKETS):
+            return float('inf')
+        return BUCKETS[index]
+
+    async def _run(self, method, args):
+        start = time.perf_counter()
+        try:
+            return await method(self.query, *args)
+        finally:
+            self.record(time.perf_counter() - start)
+
+    async def fetch(self, connection, *args):
+        return await self._run(connection.fetch, args)
+
+    async def fetchrow(self, connection, *args):
+        return await self._run(connection.fetchrow, args)
+
+    async def fetchval(self, connection, *args):
+        return await self._run(connection.fetchval, args)
+
+    async def execute(self, connection, *args):
+        return await self._run(connection.execute, args)
+
+
+class StatementRegistry:
+
+    def __init__(self):
+        self.statements = {}
+
+    def register(self, name, query):
+        if name in self.statements:
+            # Reloading a cog registers its statements again, so keep the numbers that were there
+            statement = self.statements[name]
+            statement.query = query
+            return statement
+        statement = Statement(name, query)
+        self.statements[name] = statement
+        return statement
+
+    def __getitem__(self, name):
+        return self.statements[name]
+
+    def __iter__(self):
+        return iter(self.statements.values())
+
+
+registry = StatementRegistry()
+
+
+def register(name, query):
+    return registry.register(name, query)
@@ -8,33 +8,25 @@ Rapptz did in RoboDanny.
 Tutorial on how this stuff works: https://realpython.com/primer-on-python-decorators/#caching-return-values
 """
 import asyncio
-import inspect
+import heapq
+import itertools
 import time
+from collections import OrderedDict
 from functools import wraps
 
-from lru import LRU
-
-
-def _wrap_and_store_coroutine(parent_cache, key, coroutine_func):
-    async def func():
-        function_result = await coroutine_func
-        parent_cache[key] = function_result
-        return function_result
-
-    return func()
-
-
-def _wrap_new_coroutine(function_to_wrap):
-    async def new_coroutine():
-        return function_to_wrap
-
-    return new_coroutine()
-
 
 # https://github.com/Rapptz/RoboDanny/blob/rewrite/cogs/utils/cache.py#L22
 class ExpiringDict(dict):   # noqa: WPS600
+    """
+    Dict where every entry expires after a while.
+
+    Expiry times are kept in a heap, so only entries that actually expired get looked at instead of every entry.
+    """
+
     def __init__(self, seconds):
         self._default_expiring = seconds
+        self._expiry = []
+        self._counter = itertools.count()
         super().__init__()
 
     def __contains__(self, key):
@@ -51,68 +43,225 @@ class ExpiringDict(dict):   # noqa: WPS600
     def __setitem__(self, key, value, *, seconds=-1):  # noqa: WPS110
         if seconds < 0:
             seconds = self._default_expiring
-        super().__setitem__(key, (value, time.monotonic() + seconds))
+        time_expire = time.monotonic() + seconds
+        super().__setitem__(key, (value, time_expire))
+        # The counter breaks ties so keys never have to be compared
+        heapq.heappush(self._expiry, (time_expire, next(self._counter), key))
+        if len(self._expiry) > len(self) * 2 + 64:
+            # Setting keys again leaves old times in the heap, so rebuild it once there's too many
+            self._expiry = [
+                (time_expire, next(self._counter), key) for key, (_, time_expire) in super().items()
+            ]
+            heapq.heapify(self._expiry)
 
     def _verify_cache_integrity(self):
-        # Have to do this in two steps...
         current_time = time.monotonic()
-        to_remove = [
-            key for (key, (_, time_expire)) in self.items() if current_time > time_expire
-        ]
-        for key in to_remove:
-            self.pop(key)
+        heap = self._expiry
+        while heap and current_time > heap[0][0]:
+            time_expire, _, key = heapq.heappop(heap)
+            entry = super().get(key)
+            # The key could have been set again with a later time
+            if entry is not None and entry[1] == time_expire:
+                super().__delitem__(key)
+
+
+MISSING = object()
+
+
+class SizedLRU:
+    """
+    LRU cache for bytes that evicts based on the total amount of bytes stored instead of the amount of entries.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    @staticmethod
+    def _size_of(value):
+        if value is None:
+            return 0
+        return len(value)
+
+    def get(self, key, default=None):
+        value = self._data.get(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):  # noqa: WPS110
+        size = self._size_of(value)
+        if size > self.max_bytes:
+            return
+        self.pop(key)
+        self._data[key] = value
+        self.size += size
+        while self.size > self.max_bytes:
+            _, removed = self._data.popitem(last=False)
+            self.size -= self._size_of(removed)
+
+    def pop(self, key):
+        value = self._data.pop(key, MISSING)
+        if value is MISSING:
+            return None
+        self.size -= self._size_of(value)
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
 
+_KWARGS = object()
 
-def create_key(func, *args, **kwargs):
-    def _true_repr(argument):
-        if argument.__class__.__repr__ is object.__repr__:  # noqa: WPS609
-            return '<{0.__module__}.{0.__class__.__name__}>'.format(argument.__class__)
-        return repr(argument)
 
-    key = ['{0.__module__}.{0.__name__}'.format(func)]  # noqa: WPS609
-    key.extend(_true_repr(argument) for argument in args)
-    for argument, argument_value in kwargs.items():
-        key.append(_true_repr(argument))
-        key.append(_true_repr(argument_value))
-    return ':'.join(key)
+def make_key(args, kwargs):
+    """Keys are the arguments themselves, so they need to be hashable."""
+    if not kwargs:
+        return args
+    return args + (_KWARGS,) + tuple(sorted(kwargs.items()))
 
 
-# TODO remake this as a class
-def cache(maxsize=64):  # noqa: C901,WPS212,WPS231
-    def decorator(func):  # noqa: WPS212,WPS231
-        internal_cache = LRU(maxsize)
+class AsyncCache:
+    """
+    LRU cache for coroutine results with an optional time to live per entry.
+
+    Concurrent misses for the same key share one load instead of all going to the database. Loads that find nothing
+    (None) are only kept for `miss_ttl` seconds.
+    """
+
+    def __init__(self, name, *, maxsize=64, ttl=None, miss_ttl=30):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        value, expires = entry
+        if expires is not None and time.monotonic() > expires:
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, *, ttl=MISSING):  # noqa: WPS110
+        if ttl is MISSING:
+            ttl = self.ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        # A load that's still running would store an old value, so drop it too
+        self._pending.pop(key, None)
+        return self._data.pop(key, None) is not None
+
+    def clear(self):
+        self._pending.clear()
+        self._data.clear()
+
+    async def get_or_load(self, key, loader):
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            self.hits += 1
+            return value
+        task = self._pending.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            self.misses += 1
+            # The load is its own task so the caller that started it being cancelled doesn't cancel everyone else
+            task = asyncio.ensure_future(self._load(key, loader))
+            task.add_done_callback(self._load_done)
+            self._pending[key] = task
+        return await asyncio.shield(task)
+
+    async def _load(self, key, loader):
+        try:
+            value = await loader()
+        finally:
+            if self._pending.get(key) is asyncio.current_task():
+                del self._pending[key]
+            else:
+                # Invalidated while loading, the value is already out of date
+                key = MISSING
+        if key is not MISSING:
+            # Nothing found might not stay that way, so it's only remembered for a bit
+            ttl = MISSING if value is not None else min(self.miss_ttl, self.ttl or self.miss_ttl)
+            self.set(key, value, ttl=ttl)
+        return value
+
+    @staticmethod
+    def _load_done(task):
+        # Nobody might be waiting on it anymore, which would make asyncio complain
+        if not task.cancelled():
+            task.exception()
+
+
+class CacheRegistry:
+
+    def __init__(self):
+        self.caches = {}
+
+    def add(self, cache_obj):
+        # Reloading a cog makes its caches again, which replaces the old ones
+        self.caches[cache_obj.name] = cache_obj
+        return cache_obj
+
+    def __iter__(self):
+        return iter(self.caches.values())
+
+
+registry = CacheRegistry()
+
+
+def cache(maxsize=64, *, ttl=None, name=None):
+    """Caches a coroutine function by its arguments, including self for methods."""
+
+    def decorator(func):
+        store = registry.add(AsyncCache(
+            name or '{0.__module__}.{0.__qualname__}'.format(func), maxsize=maxsize, ttl=ttl,
+        ))
 
         @wraps(func)
-        def wrapper(*args, **kwargs):
-            key = create_key(func, args, kwargs)
-            stored_value = internal_cache.get(key, None)
-            if stored_value is None:
-                stored_value = func(*args, **kwargs)
-                if inspect.isawaitable(stored_value):
-                    return _wrap_and_store_coroutine(internal_cache, key, stored_value)
-                internal_cache[key] = stored_value  # noqa: WPS529
-
-            if asyncio.iscoroutinefunction(func):
-                return _wrap_new_coroutine(stored_value)
-            return stored_value
+        async def wrapper(*args, **kwargs):
+            return await store.get_or_load(make_key(args, kwargs), lambda: func(*args, **kwargs))
 
         def _invalidate(*args, **kwargs):
-            key = create_key(func, args, kwargs)
-            if key in internal_cache:
-                # No other function to replicate del
-                del internal_cache[key]  # noqa: WPS420,WPS529
-                return True
-            return False
-
-        def _invalidate_containing(key):
-            for cache_key in internal_cache.keys():
-                if key in cache_key:
-                    # No other function to replicate del
-                    del internal_cache[cache_key]  # noqa: WPS420,WPS529
-
-        wrapper.cache = internal_cache
+            return store.invalidate(make_key(args, kwargs))
+
+        wrapper.cache = store
         wrapper.invalidate = _invalidate
-        wrapper.invalidate_containing = _invalidate_containing
         return wrapper
 
     return decorator
@@ -0,0 +1,61 @@
+import asyncio
+import os
+
+import pytest
+
+DATABASE = os.environ.get('SYNTH_TEST_DATABASE')
+if not DATABASE:
+    pytest.skip('SYNTH_TEST_DATABASE is not set', allow_module_level=True)
+
+import asyncpg  # noqa: E402
+
+from bot.cogs.stats import flatten  # noqa: E402
+
+HOURLY = """
+CREATE TEMPORARY TABLE messages_hourly (
+    guild_id BIGINT NOT NULL,
+    time TIMESTAMP NOT NULL,
+    amount INTEGER NOT NULL DEFAULT 0,
+    CONSTRAINT unique_message_hour UNIQUE (guild_id, time)
+);
+"""
+
+# Three hours of one old day, one of them at midnight, and an hour from today
+ROWS = """
+INSERT INTO messages_hourly(guild_id, time, amount) VALUES
+(1, date_trunc('day', NOW() at time zone 'utc') - INTERVAL '10 DAYS', 1),
+(1, date_trunc('day', NOW() at time zone 'utc') - INTERVAL '10 DAYS' + INTERVAL '5 HOURS', 2),
+(1, date_trunc('day', NOW() at time zone 'utc') - INTERVAL '10 DAYS' + INTERVAL '17 HOURS', 4),
+(1, date_trunc('hour', NOW() at time zone 'utc'), 8);
+"""
+
+
+def flatten_hourly(*runs):
+    async def run():
+        connection = await asyncpg.connect(DATABASE)
+        try:
+            await connection.execute(HOURLY)
+            await connection.execute(ROWS)
+            flattener = flatten.MessageFlattener(passes=[
+                entry for entry in flatten.PASSES if entry[0] == 'hourly_time'
+            ])
+            for days in runs:
+                await flattener.flatten(connection, {1: {'time': days}})
+            return await connection.fetch('SELECT time, amount FROM messages_hourly ORDER BY time;')
+        finally:
+            await connection.close()
+    return asyncio.run(run())
+
+
+def test_old_hours_fold_into_their_day():
+    entries = flatten_hourly(7)
+    assert [entry['amount'] for entry in entries] == [7, 8]
+    assert entries[0]['time'].hour == 0
+
+
+def test_running_again_changes_nothing():
+    assert [entry['amount'] for entry in flatten_hourly(7, 7)] == [7, 8]
+
+
+def test_recent_hours_are_kept():
+    assert [entry['amount'] for entry in flatten_hourly(30)] == [1, 2, 4, 8]
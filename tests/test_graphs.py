@@ -0,0 +1,33 @@
+import numpy as np
+
+from bot.util import graphs
+
+
+def hour_curve(hours):
+    # Same as the overlay in plot_24_hour_messages
+    y = np.asarray(hours, dtype=np.float64)
+    grid = np.linspace(0, 24, 24 * 12 + 1)
+    return graphs.weighted_kde(np.arange(24) + 0.5, y, grid, min_bandwidth=0.5) * y.sum()
+
+
+def test_single_hour_stays_on_bar_scale():
+    hours = np.zeros(24)
+    hours[13] = 7
+    curve = hour_curve(hours)
+    assert 0 < curve.max() <= hours.max()
+
+
+def test_two_hours_stay_on_bar_scale():
+    hours = np.zeros(24)
+    hours[13] = 3
+    hours[14] = 4
+    curve = hour_curve(hours)
+    assert 0 < curve.max() <= hours.max()
+
+
+def test_single_bucket_week_day_is_not_a_spike():
+    grid = np.linspace(0, 24 * 60 * 60, 24 * 12 + 1)
+    quiet = graphs.weighted_kde([12 * 60 * 60], [1], grid, min_bandwidth=30 * 60)
+    busy = graphs.weighted_kde(np.arange(48) * 1800 + 900, np.full(48, 10), grid, min_bandwidth=30 * 60) * 480
+    # The quiet day scaled by its count shouldn't be wider than the busy one
+    assert quiet.max() < busy.max()
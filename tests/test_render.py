@@ -0,0 +1,27 @@
+import time
+
+import matplotlib
+import pytest
+
+matplotlib.use('Agg')
+
+from matplotlib import pyplot as plt  # noqa: E402
+
+from bot.util import render  # noqa: E402
+
+
+def slow_figure():
+    plt.figure()
+    time.sleep(1)
+
+
+def test_timed_out_job_closes_figures():
+    with pytest.raises(render._JobTimeout):
+        render._run_job(slow_figure, (), {}, 0.1)
+    assert plt.get_fignums() == []
+
+
+def test_finished_job_closes_figures():
+    _, render_time = render._run_job(plt.figure, (), {}, 5)
+    assert render_time >= 0
+    assert plt.get_fignums() == []
@@ -0,0 +1,21 @@
+import datetime
+
+from bot.cogs.stats import voice
+
+
+def test_stop_before_checkpoint_has_no_slices():
+    log = voice.VoiceLog(1, 2, 3)
+    log.checkpoint = datetime.datetime(2021, 5, 1, 12, 10, 30, 400000)
+    # Rounded down to the second, so it's before the checkpoint in the same bucket
+    log.stop = datetime.datetime(2021, 5, 1, 12, 10, 30)
+    assert list(log.slices(log.stop)) == []
+    assert log.is_written()
+
+
+def test_stop_after_checkpoint_in_same_bucket():
+    log = voice.VoiceLog(1, 2, 3)
+    log.checkpoint = datetime.datetime(2021, 5, 1, 12, 10)
+    log.stop = datetime.datetime(2021, 5, 1, 12, 25)
+    assert list(log.slices(log.stop)) == [
+        (datetime.datetime(2021, 5, 1, 12, 0), datetime.timedelta(minutes=15)),
+    ]
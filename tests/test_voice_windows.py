@@ -0,0 +1,60 @@
+import asyncio
+import os
+
+import pytest
+
+DATABASE = os.environ.get('SYNTH_TEST_DATABASE')
+if not DATABASE:
+    pytest.skip('SYNTH_TEST_DATABASE is not set', allow_module_level=True)
+
+import asyncpg  # noqa: E402
+
+from bot.cogs.stats import queries  # noqa: E402
+from bot.cogs.stats.channels import voice_channel  # noqa: E402
+
+# Same shape as VoiceTable, made temporary so nothing is left behind
+VOICE = """
+CREATE TEMPORARY TABLE voice (
+    guild_id BIGINT NOT NULL,
+    channel_id BIGINT,
+    user_id BIGINT,
+    time TIMESTAMP NOT NULL,
+    amount INTERVAL NOT NULL,
+    interval INTERVAL DEFAULT INTERVAL '30 MINUTES'
+);
+"""
+
+# A flattened day from three days ago that summed more time than the window is long, and one recent raw row
+ROWS = """
+INSERT INTO voice(guild_id, channel_id, user_id, time, amount, interval) VALUES
+(1, 10, NULL, date_trunc('day', NOW() at time zone 'utc') - INTERVAL '3 DAYS', INTERVAL '100 HOURS', INTERVAL '1 DAY'),
+(1, 10, 20, date_trunc('hour', NOW() at time zone 'utc') - INTERVAL '1 HOUR', INTERVAL '20 MINUTES', INTERVAL '30 MINUTES');
+"""
+
+
+def with_voice(function):
+    async def run():
+        connection = await asyncpg.connect(DATABASE)
+        try:
+            await connection.execute(VOICE)
+            await connection.execute(ROWS)
+            return await function(connection)
+        finally:
+            await connection.close()
+    return asyncio.run(run())
+
+
+def test_summary_skips_flattened_rows_outside_window():
+    async def fetch(connection):
+        return await queries.VoiceSummary.fetch(connection, 'guild_id = 1', '1 DAY')
+
+    summary = with_voice(fetch)
+    assert summary.total() == 20 * 60
+
+
+def test_stat_channel_skips_flattened_rows_outside_window():
+    async def fetch(connection):
+        return await voice_channel.VOICE_WINDOW.fetch(connection, [1], voice_channel.VoiceStatChannel().parse('24'))
+
+    entries = with_voice(fetch)
+    assert [float(entry['seconds']) for entry in entries] == [20 * 60]